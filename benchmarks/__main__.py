@@ -0,0 +1,212 @@
+"""Run the benchmark suite against an in-process broker.
+
+Usage: python -m benchmarks [--counts 10,100,1000,5000] [--output results.json]
+
+Results are written as JSON so that runs can be compared and regressions in
+the entity hot path caught.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import typing
+
+import aiomqtt
+
+from benchmarks.broker import Broker
+from benchmarks.importtime import DEFAULT_MODULES, importtime
+from benchmarks.synthetic import SyntheticButton, SyntheticSensor
+from mqttdevice.device import Device
+from mqttdevice.gateway import Gateway
+from mqttdevice.serializer import get_serializer
+
+# Bytes per sensor entity, including its config, documented in the README
+MEMORY_BUDGET = 1536
+# Bytes per device hosted by a gateway, without its entities
+DEVICE_MEMORY_BUDGET = 6144
+
+
+def device_config(port: int, plugins: list[dict] | None = None) -> dict:
+    return {
+        "mqtt": {"host": "127.0.0.1", "port": port, "username": None, "password": None},
+        "device_name": "benchmark",
+        # Entities are driven by the benchmarks, not the scheduler
+        "polling_interval": 0,
+        "plugins": plugins or [],
+    }
+
+
+@contextlib.asynccontextmanager
+async def running(device: Device, ready: typing.Callable[[], bool]):
+    # Runs the device, yielding once the initial discovery and state
+    # publishes are done
+    task = asyncio.create_task(device.loop())
+    try:
+        while not ready():
+            await asyncio.sleep(0.01)
+        yield
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        device.probes.shutdown()
+
+
+def bench_import() -> dict:
+    timings = importtime(DEFAULT_MODULES)
+    return {
+        "total_us": sum(self_us for _, self_us, _ in timings),
+        "modules": len(timings),
+    }
+
+
+def bench_startup(port: int, repeat: int = 20) -> dict:
+    plugins = [
+        {"plugin": "availability", "id": "availability"},
+        {"plugin": "uptime", "id": "uptime"},
+        {"plugin": "command", "id": "command", "command": "true"},
+    ]
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        device = Device(device_config(port, plugins))
+        durations.append(time.perf_counter() - start)
+        device.probes.shutdown()
+    return {"median_s": statistics.median(durations), "min_s": min(durations)}
+
+
+def bench_memory(port: int, count: int) -> dict:
+    device = Device(device_config(port))
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(count):
+        SyntheticSensor(device, {"id": f"sensor_{i}"})
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    device.probes.shutdown()
+    return {
+        "entities": count,
+        "bytes_per_entity": allocated / count,
+        "budget": MEMORY_BUDGET,
+        "within_budget": allocated / count <= MEMORY_BUDGET,
+    }
+
+
+def bench_gateway_memory(port: int, count: int) -> dict:
+    gateway = Gateway({**device_config(port), "devices": []})
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(count):
+        device = gateway.add_device({"device_name": f"device_{i}", "plugins": []})
+        # Discovery of its first entity builds the device's cached payloads
+        device.shared_discovery_fragment
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    gateway.probes.shutdown()
+    return {
+        "devices": count,
+        "bytes_per_device": allocated / count,
+        "budget": DEVICE_MEMORY_BUDGET,
+        "within_budget": allocated / count <= DEVICE_MEMORY_BUDGET,
+    }
+
+
+async def bench_throughput(
+    broker: Broker, port: int, count: int, rounds: int = 5
+) -> dict:
+    device = Device(device_config(port))
+    entities = [SyntheticSensor(device, {"id": f"sensor_{i}"}) for i in range(count)]
+    # Availability, then discovery and state for every entity
+    expected = broker.received + 1 + count * 2
+    async with running(device, lambda: broker.received >= expected):
+        start = time.perf_counter()
+        for i in range(rounds):
+            for entity in entities:
+                entity.value = i + 1
+            await asyncio.gather(*(entity.publish_state() for entity in entities))
+        elapsed = time.perf_counter() - start
+    publishes = count * rounds
+    return {
+        "entities": count,
+        "publishes": publishes,
+        "seconds": elapsed,
+        "publishes_per_second": publishes / elapsed,
+    }
+
+
+async def bench_button_latency(broker: Broker, port: int, presses: int = 200) -> dict:
+    device = Device(device_config(port))
+    button = SyntheticButton(device, {"id": "button"})
+    async with running(device, lambda: button.set_topic in device.message_routes):
+        async with aiomqtt.Client("127.0.0.1", port) as client:
+            for _ in range(presses):
+                await client.publish(button.set_topic, str(time.perf_counter()))
+                await asyncio.sleep(0.001)
+            while len(button.latencies) < presses:
+                await asyncio.sleep(0.01)
+    latencies = sorted(button.latencies)
+    return {
+        "presses": presses,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+async def main(counts: list[int]) -> dict:
+    broker = Broker()
+    port = await broker.start()
+    try:
+        results = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "serializer": get_serializer().name,
+            "import": bench_import(),
+            "startup": bench_startup(port),
+            "memory": [bench_memory(port, count) for count in counts],
+            "gateway_memory": [bench_gateway_memory(port, count) for count in counts],
+            "throughput": [
+                await bench_throughput(broker, port, count) for count in counts
+            ],
+            "button_latency": await bench_button_latency(broker, port),
+        }
+    finally:
+        await broker.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--counts",
+        default="10,100,1000,5000",
+        type=lambda counts: [int(count) for count in counts.split(",")],
+        help="Comma separated numbers of synthetic entities",
+    )
+    parser.add_argument(
+        "--output", type=argparse.FileType("w"), default=sys.stdout, help="JSON file"
+    )
+    args = parser.parse_args()
+    # Keep the device's own output out of the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(main(args.counts))
+    json.dump(results, args.output, indent=2)
+    args.output.write("\n")
+    if not all(memory["within_budget"] for memory in results["memory"]):
+        sys.exit("Memory per entity is over budget")
+    if not all(memory["within_budget"] for memory in results["gateway_memory"]):
+        sys.exit("Memory per gateway device is over budget")
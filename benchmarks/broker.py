@@ -0,0 +1,184 @@
+"""A minimal in-process MQTT 3.1.1 broker for benchmarks.
+
+Supports what mqttdevice uses: CONNECT with a will, PUBLISH at QoS 0 and 1,
+retained messages, SUBSCRIBE/UNSUBSCRIBE with + and # wildcards, PINGREQ and
+DISCONNECT. Messages are always delivered to subscribers at QoS 0.
+"""
+from __future__ import annotations
+
+import asyncio
+import struct
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value: bytes) -> bytes:
+    return struct.pack("!H", len(value)) + value
+
+
+def packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic: bytes, payload: bytes, retain: bool = False) -> bytes:
+    return packet(PUBLISH, int(retain), encode_string(topic) + payload)
+
+
+class Session:
+    def __init__(self, broker: Broker, writer: asyncio.StreamWriter):
+        self.broker = broker
+        self.writer = writer
+        self.subscriptions: set[str] = set()
+        self.will: tuple[bytes, bytes, bool] | None = None
+
+    def send(self, data: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class Broker:
+    def __init__(self):
+        self.sessions: set[Session] = set()
+        self.retained: dict[bytes, bytes] = dict()
+        self.received = 0
+        self._server: asyncio.Server | None = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        for session in list(self.sessions):
+            session.writer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def route(self, topic: bytes, payload: bytes, retain: bool):
+        self.received += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        decoded = topic.decode()
+        data = publish_packet(topic, payload)
+        for session in self.sessions:
+            if any(topic_matches(f, decoded) for f in session.subscriptions):
+                session.send(data)
+
+    async def _read_packet(
+        self, reader: asyncio.StreamReader
+    ) -> tuple[int, int, bytes]:
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, await reader.readexactly(length)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = Session(self, writer)
+        self.sessions.add(session)
+        clean = False
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == CONNECT:
+                    self._on_connect(session, body)
+                elif packet_type == PUBLISH:
+                    self._on_publish(session, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self._on_subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self._on_unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    session.send(packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            if not clean and session.will is not None:
+                self.route(*session.will)
+            writer.close()
+
+    def _on_connect(self, session: Session, body: bytes):
+        offset = 2 + struct.unpack_from("!H", body)[0]  # protocol name
+        connect_flags = body[offset + 1]
+        offset += 4  # level, flags, keepalive
+        strings = []
+        while offset < len(body):
+            (length,) = struct.unpack_from("!H", body, offset)
+            strings.append(body[offset + 2 : offset + 2 + length])
+            offset += 2 + length
+        if connect_flags & 0x04:
+            retain = bool(connect_flags & 0x20)
+            session.will = (strings[1], strings[2], retain)
+        session.send(packet(CONNACK, 0, b"\x00\x00"))
+
+    def _on_publish(self, session: Session, flags: int, body: bytes):
+        qos = (flags >> 1) & 0x03
+        (length,) = struct.unpack_from("!H", body)
+        topic = body[2 : 2 + length]
+        offset = 2 + length
+        if qos:
+            packet_id = body[offset : offset + 2]
+            offset += 2
+            session.send(packet(PUBACK, 0, packet_id))
+        self.route(topic, body[offset:], bool(flags & 0x01))
+
+    def _on_subscribe(self, session: Session, body: bytes):
+        packet_id, offset = body[:2], 2
+        granted = bytearray()
+        filters = []
+        while offset < len(body):
+            (length,) = struct.unpack_from("!H", body, offset)
+            filters.append(body[offset + 2 : offset + 2 + length].decode())
+            offset += 3 + length
+            granted.append(0)
+        session.subscriptions.update(filters)
+        session.send(packet(SUBACK, 0, packet_id + bytes(granted)))
+        for topic, payload in self.retained.items():
+            if any(topic_matches(f, topic.decode()) for f in filters):
+                session.send(publish_packet(topic, payload, retain=True))
+
+    def _on_unsubscribe(self, session: Session, body: bytes):
+        packet_id, offset = body[:2], 2
+        while offset < len(body):
+            (length,) = struct.unpack_from("!H", body, offset)
+            session.subscriptions.discard(
+                body[offset + 2 : offset + 2 + length].decode()
+            )
+            offset += 2 + length
+        session.send(packet(UNSUBACK, 0, packet_id))
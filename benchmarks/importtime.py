@@ -0,0 +1,57 @@
+"""Report the import cost of mqttdevice using ``python -X importtime``.
+
+Usage: python -m benchmarks.importtime [module ...]
+
+Prints a JSON document with the total import time and the slowest modules
+by cumulative time, so startup regressions can be tracked over time.
+"""
+from __future__ import annotations
+
+import json
+import subprocess
+import sys
+
+DEFAULT_MODULES = [
+    "mqttdevice.device",
+    "mqttdevice.plugins.availability",
+    "mqttdevice.plugins.command",
+    "mqttdevice.plugins.pactl",
+    "mqttdevice.plugins.uptime",
+    "mqttdevice.plugins.webcam",
+]
+
+
+def importtime(modules: list[str]) -> list[tuple[str, int, int]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        timings.append((name.strip(), int(self_us), int(cumulative_us)))
+    return timings
+
+
+def main(modules: list[str], top: int = 15):
+    timings = importtime(modules)
+    slowest = sorted(timings, key=lambda timing: timing[2], reverse=True)[:top]
+    report = {
+        "modules": modules,
+        "total_us": sum(self_us for _, self_us, _ in timings),
+        "imported": len(timings),
+        "slowest": [
+            {"module": name, "self_us": self_us, "cumulative_us": cumulative_us}
+            for name, self_us, cumulative_us in slowest
+        ],
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or DEFAULT_MODULES)
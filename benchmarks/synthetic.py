@@ -0,0 +1,31 @@
+"""Entities that do no real work, for measuring mqttdevice's own overhead."""
+from __future__ import annotations
+
+import time
+
+from aiomqtt.client import Message
+
+from mqttdevice.entities import Button
+from mqttdevice.entities.sensor import Sensor
+
+
+class SyntheticSensor(Sensor):
+    __slots__ = ("value",)
+
+    def __init__(self, *args, **kwargs):
+        self.value = 0
+        super().__init__(*args, **kwargs)
+
+    async def get_state(self) -> int:
+        return self.value
+
+
+class SyntheticButton(Button):
+    __slots__ = ("latencies",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies: list[float] = list()
+
+    async def on_message(self, message: Message):
+        self.latencies.append(time.perf_counter() - float(message.payload))
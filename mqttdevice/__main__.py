@@ -6,6 +6,8 @@ import logging
 import yaml
 
 from mqttdevice.device import Device
+from mqttdevice.gateway import Gateway
+from mqttdevice.reload import ConfigReloader
 
 logger = logging.getLogger("mqttdevice")
 logging.basicConfig(level=logging.INFO)
@@ -13,11 +15,13 @@ logging.basicConfig(level=logging.INFO)
 
 async def main(args):
     config = yaml.safe_load(args.config)
-    device = Device(config)
-    async with asyncio.TaskGroup() as tg:
-        tg.create_task(device.loop())
-        for entity in device.entities.values():
-            tg.create_task(entity.loop())
+    # With a devices list, one process hosts them all over one connection
+    device = Gateway(config) if "devices" in config else Device(config)
+    # Plugins are reloaded from the file on SIGHUP, or when it changes with --watch
+    reloader = ConfigReloader(device, args.config.name).install()
+    if args.watch:
+        device.add_service(reloader.watch)
+    await device.loop()
 
 
 if __name__ == "__main__":
@@ -32,6 +36,11 @@ if __name__ == "__main__":
         required=False,
     )
     parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Reload plugins when the config file changes",
+    )
     args = parser.parse_args()
     if args.verbose:
         logger.setLevel(logging.DEBUG)
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import random
+import typing
+
+
+class BackoffConfig(typing.TypedDict):
+    initial: float | None
+    maximum: float | None
+    factor: float | None
+    jitter: float | None
+
+
+class Backoff:
+    def __init__(self, config: BackoffConfig):
+        self.config = config
+        self.attempts = 0
+
+    @property
+    def initial(self) -> float:
+        return float(self.config.get("initial", 1))
+
+    @property
+    def maximum(self) -> float:
+        return float(self.config.get("maximum", 120))
+
+    @property
+    def factor(self) -> float:
+        return float(self.config.get("factor", 2))
+
+    @property
+    def jitter(self) -> float:
+        return float(self.config.get("jitter", 0.5))
+
+    def reset(self):
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.maximum, self.initial * self.factor**self.attempts)
+        self.attempts += 1
+        # Randomise so that every agent that lost a restarting broker doesn't
+        # reconnect at the same moment
+        return random.uniform(delay * (1 - self.jitter), delay)
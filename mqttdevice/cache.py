@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import asyncio
+import time
+import typing
+
+K = typing.Hashable
+T = typing.TypeVar("T")
+
+
+class SnapshotCache(typing.Generic[T]):
+    """Caches the result of an expensive probe for ``ttl`` seconds per key.
+
+    Callers that ask for a key while it is being loaded share the same
+    in-flight load instead of starting their own.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._values: dict[K, tuple[float, T]] = dict()
+        self._loading: dict[K, asyncio.Future[T]] = dict()
+
+    async def get(self, key: K, loader: typing.Callable[[], typing.Awaitable[T]]) -> T:
+        cached = self._values.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+
+        future = self._loading.get(key)
+        if future is None:
+            future = asyncio.ensure_future(loader())
+            self._loading[key] = future
+            future.add_done_callback(lambda f: self._store(key, f))
+        # Shield so one cancelled caller doesn't cancel the load for the others
+        return await asyncio.shield(future)
+
+    def _store(self, key: K, future: asyncio.Future[T]):
+        # A load that was invalidated while in flight is dropped, it may be
+        # older than the snapshot loaded since
+        if self._loading.get(key) is not future:
+            return
+        del self._loading[key]
+        if not future.cancelled() and future.exception() is None:
+            self._values[key] = (time.monotonic(), future.result())
+
+    def invalidate(self, key: K | None = None):
+        # Also forget in-flight loads, they may have started before whatever
+        # made the caller invalidate.
+        if key is None:
+            self._values.clear()
+            self._loading.clear()
+        else:
+            self._values.pop(key, None)
+            self._loading.pop(key, None)
@@ -0,0 +1,164 @@
+# Constants mirrored from Home Assistant, so that the agent doesn't need the
+# whole homeassistant package (seconds of startup and tens of MB of RSS) just
+# to get at a handful of strings. Values must match homeassistant.const and
+# homeassistant.components.*.
+from enum import StrEnum
+
+BINARY_SENSOR_DOMAIN = "binary_sensor"
+BUTTON_DOMAIN = "button"
+SENSOR_DOMAIN = "sensor"
+
+
+class BinarySensorDeviceClass(StrEnum):
+    BATTERY = "battery"
+    BATTERY_CHARGING = "battery_charging"
+    CO = "carbon_monoxide"
+    COLD = "cold"
+    CONNECTIVITY = "connectivity"
+    DOOR = "door"
+    GARAGE_DOOR = "garage_door"
+    GAS = "gas"
+    HEAT = "heat"
+    LIGHT = "light"
+    LOCK = "lock"
+    MOISTURE = "moisture"
+    MOTION = "motion"
+    MOVING = "moving"
+    OCCUPANCY = "occupancy"
+    OPENING = "opening"
+    PLUG = "plug"
+    POWER = "power"
+    PRESENCE = "presence"
+    PROBLEM = "problem"
+    RUNNING = "running"
+    SAFETY = "safety"
+    SMOKE = "smoke"
+    SOUND = "sound"
+    TAMPER = "tamper"
+    UPDATE = "update"
+    VIBRATION = "vibration"
+    WINDOW = "window"
+
+
+class ButtonDeviceClass(StrEnum):
+    IDENTIFY = "identify"
+    RESTART = "restart"
+    UPDATE = "update"
+
+
+class SensorDeviceClass(StrEnum):
+    DATE = "date"
+    ENUM = "enum"
+    TIMESTAMP = "timestamp"
+    APPARENT_POWER = "apparent_power"
+    AQI = "aqi"
+    AREA = "area"
+    ATMOSPHERIC_PRESSURE = "atmospheric_pressure"
+    BATTERY = "battery"
+    BLOOD_GLUCOSE_CONCENTRATION = "blood_glucose_concentration"
+    CO = "carbon_monoxide"
+    CO2 = "carbon_dioxide"
+    CONDUCTIVITY = "conductivity"
+    CURRENT = "current"
+    DATA_RATE = "data_rate"
+    DATA_SIZE = "data_size"
+    DISTANCE = "distance"
+    DURATION = "duration"
+    ENERGY = "energy"
+    ENERGY_DISTANCE = "energy_distance"
+    ENERGY_STORAGE = "energy_storage"
+    FREQUENCY = "frequency"
+    GAS = "gas"
+    HUMIDITY = "humidity"
+    ILLUMINANCE = "illuminance"
+    IRRADIANCE = "irradiance"
+    MOISTURE = "moisture"
+    MONETARY = "monetary"
+    NITROGEN_DIOXIDE = "nitrogen_dioxide"
+    NITROGEN_MONOXIDE = "nitrogen_monoxide"
+    NITROUS_OXIDE = "nitrous_oxide"
+    OZONE = "ozone"
+    PH = "ph"
+    PM1 = "pm1"
+    PM10 = "pm10"
+    PM25 = "pm25"
+    POWER_FACTOR = "power_factor"
+    POWER = "power"
+    PRECIPITATION = "precipitation"
+    PRECIPITATION_INTENSITY = "precipitation_intensity"
+    PRESSURE = "pressure"
+    REACTIVE_POWER = "reactive_power"
+    SIGNAL_STRENGTH = "signal_strength"
+    SOUND_PRESSURE = "sound_pressure"
+    SPEED = "speed"
+    SULPHUR_DIOXIDE = "sulphur_dioxide"
+    TEMPERATURE = "temperature"
+    VOLATILE_ORGANIC_COMPOUNDS = "volatile_organic_compounds"
+    VOLATILE_ORGANIC_COMPOUNDS_PARTS = "volatile_organic_compounds_parts"
+    VOLTAGE = "voltage"
+    VOLUME = "volume"
+    VOLUME_STORAGE = "volume_storage"
+    VOLUME_FLOW_RATE = "volume_flow_rate"
+    WATER = "water"
+    WEIGHT = "weight"
+    WIND_DIRECTION = "wind_direction"
+    WIND_SPEED = "wind_speed"
+
+
+class UnitOfTime(StrEnum):
+    MICROSECONDS = "μs"
+    MILLISECONDS = "ms"
+    SECONDS = "s"
+    MINUTES = "min"
+    HOURS = "h"
+    DAYS = "d"
+    WEEKS = "w"
+    MONTHS = "m"
+    YEARS = "y"
+
+
+PERCENTAGE = "%"
+
+
+class UnitOfInformation(StrEnum):
+    BITS = "bit"
+    KILOBITS = "kbit"
+    MEGABITS = "Mbit"
+    GIGABITS = "Gbit"
+    BYTES = "B"
+    KILOBYTES = "kB"
+    MEGABYTES = "MB"
+    GIGABYTES = "GB"
+    TERABYTES = "TB"
+    PETABYTES = "PB"
+    EXABYTES = "EB"
+    ZETTABYTES = "ZB"
+    YOTTABYTES = "YB"
+    KIBIBYTES = "KiB"
+    MEBIBYTES = "MiB"
+    GIBIBYTES = "GiB"
+    TEBIBYTES = "TiB"
+    PEBIBYTES = "PiB"
+    EXBIBYTES = "EiB"
+    ZEBIBYTES = "ZiB"
+    YOBIBYTES = "YiB"
+
+
+class UnitOfDataRate(StrEnum):
+    BITS_PER_SECOND = "bit/s"
+    KILOBITS_PER_SECOND = "kbit/s"
+    MEGABITS_PER_SECOND = "Mbit/s"
+    GIGABITS_PER_SECOND = "Gbit/s"
+    BYTES_PER_SECOND = "B/s"
+    KILOBYTES_PER_SECOND = "kB/s"
+    MEGABYTES_PER_SECOND = "MB/s"
+    GIGABYTES_PER_SECOND = "GB/s"
+    KIBIBYTES_PER_SECOND = "KiB/s"
+    MEBIBYTES_PER_SECOND = "MiB/s"
+    GIBIBYTES_PER_SECOND = "GiB/s"
+
+
+class UnitOfTemperature(StrEnum):
+    CELSIUS = "°C"
+    FAHRENHEIT = "°F"
+    KELVIN = "K"
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import typing
+
+logger = logging.getLogger("mqttdevice.debounce")
+
+K = typing.TypeVar("K", bound=typing.Hashable)
+
+
+class Debouncer(typing.Generic[K]):
+    """Handles keys added within ``delay`` seconds of each other as one batch.
+
+    Keys added while the handler runs are handled by another pass once it
+    returns, so a change is never missed and the handler never runs twice at
+    once.
+    """
+
+    def __init__(
+        self, delay: float, handler: typing.Callable[[set[K]], typing.Awaitable[None]]
+    ):
+        self.delay = delay
+        self.handler = handler
+        self._pending: set[K] = set()
+        self._task: asyncio.Task | None = None
+
+    def add(self, key: K):
+        self._pending.add(key)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while self._pending:
+            await asyncio.sleep(self.delay)
+            pending, self._pending = self._pending, set()
+            try:
+                await self.handler(pending)
+            except Exception:
+                logger.exception("Error handling changes")
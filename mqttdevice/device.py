@@ -1,10 +1,13 @@
 from __future__ import annotations
 
 import asyncio
+import contextvars
+import functools
+import hashlib
 import importlib
-import json
 import logging
 import sys
+import time
 import typing
 import uuid
 from socket import gethostname
@@ -12,49 +15,327 @@ from socket import gethostname
 import aiomqtt
 from caseconverter import snakecase, titlecase
 
+from mqttdevice.dispatcher import CommandDispatcher
+from mqttdevice.exceptions import PluginNotFoundError
+from mqttdevice.metrics import Metrics, MetricsConfig, get_metrics
 from mqttdevice.mqtt_object import MQTTConfig, MQTTObject
+from mqttdevice.outbox import Outbox, OutboxConfig
+from mqttdevice.probes import ProbeConfig, ProbeExecutor
+from mqttdevice.scheduler import Scheduler, SchedulerConfig
+from mqttdevice.serializer import get_serializer
 
 if typing.TYPE_CHECKING:
+    from aiomqtt.client import Message
+
     from mqttdevice.entities import Entity
+    from mqttdevice.entities.entity import EntityWithMessage, EntityWithState
+    from mqttdevice.gateway import Gateway
 
 logger = logging.getLogger("mqttdevice.device")
 
+# The id of the plugin config being set up. Entities and services created
+# while it is set belong to that plugin, including entities created later by
+# its services, as tasks inherit it.
+current_plugin: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "current_plugin", default=None
+)
+
+Service = typing.Callable[[], typing.Awaitable]
+
 
 class Config(typing.TypedDict):
     plugins: dict[str, typing.Any]
     mqtt: MQTTConfig
+    probes: ProbeConfig
+    scheduler: SchedulerConfig
+    outbox: OutboxConfig
+    metrics: MetricsConfig
 
 
 class Device(MQTTObject):
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, gateway: Gateway | None = None):
         self.config = config
-        super().__init__(config.get("mqtt", MQTTConfig()))
+        # A device hosted by a gateway publishes through the gateway's
+        # connection and shares its scheduler, probes, metrics and outbox.
+        self.gateway = gateway
+        if gateway is None:
+            super().__init__(config.get("mqtt", MQTTConfig()))
+            self.probes = ProbeExecutor(config.get("probes", ProbeConfig()))
+            self.metrics = get_metrics(config.get("metrics"))
+            self.scheduler = Scheduler(
+                config.get("scheduler", SchedulerConfig()), self.metrics
+            )
+            self.outbox = Outbox(config.get("outbox", OutboxConfig()))
+            self.serializer = get_serializer(config.get("serializer"))
+        else:
+            super().__init__(gateway._mqtt_config, gateway.client)
+            self.probes = gateway.probes
+            self.metrics = gateway.metrics
+            self.scheduler = gateway.scheduler
+            self.outbox = gateway.outbox
+            self.serializer = gateway.serializer
+        self.dispatcher = CommandDispatcher(self.metrics)
+        # Both availability payloads, encoded once
+        self.availability_payloads = {
+            available: self.serializer.dumps(
+                {"state": "online" if available else "offline"}
+            )
+            for available in (True, False)
+        }
+        # Set before the first connection, the broker takes the will at connect
+        self.will_set(
+            self.availability_topic, self.availability_payloads[False], retain=True
+        )
 
         self.entities: dict[str, Entity] = dict()
+        self.message_routes: dict[str, EntityWithMessage] = dict()
+        # Service -> id of the plugin that added it
+        self.services: list[tuple[Service, str | None]] = list()
+        self._service_tasks: dict[str | None, list[asyncio.Task]] = dict()
+        # Plugin id -> its config and the identifiers of its entities
+        self.plugin_configs: dict[str, dict] = dict()
+        self.plugin_entities: dict[str, set[str]] = dict()
+        self._task_group: asyncio.TaskGroup | None = None
+        self._session_group: asyncio.TaskGroup | None = None
+        self._entity_tasks: dict[str, asyncio.Task] = dict()
+        # Entity id -> state payload, when states are aggregated
+        self.states: dict[str, bytes] = dict()
+        self._state_flush: asyncio.Task | None = None
+        self._state_staged = 0.0
+        # Hash of the device discovery payload the broker has retained, once
+        # the retained message (if any) has been seen
+        self._discovery_hash: bytes | None = None
+        self._retained_discovery: asyncio.Future | None = None
+        self._discovery_subscribed = False
+        self._discovery_lock = asyncio.Lock()
+        self._discovery_flush: asyncio.Task | None = None
+        self._discovery_forced = False
+        # Entity id -> domain of components to remove on the next publish
+        self._removed_components: dict[str, str] = dict()
+        self._last_availability: bytes | None = None
+        self._last_availability_published = 0.0
+        self.publish_count = 0
+        self.suppressed_count = 0
+
+        if self.metrics.enabled and gateway is None:
+            self.metrics.collectors.append(self.collect_metrics)
+            self.add_service(self.metrics.serve_http)
+            self.add_service(self.metrics.monitor_loop_lag)
+            if self.metrics.config.get("topic", True):
+                self.add_service(self.publish_diagnostics)
+
         for plugin_config in config["plugins"]:
-            plugin = plugin_config["plugin"]
             try:
-                plugin_module = importlib.import_module(f"mqttdevice.plugins.{plugin}")
-            except ModuleNotFoundError:
-                logger.error(f"No such plugin {plugin}")
+                self.setup_plugin(plugin_config)
+            except PluginNotFoundError as e:
+                logger.error(e)
                 sys.exit(1)
+
+    def setup_plugin(self, plugin_config: dict) -> typing.Self:
+        plugin = plugin_config["plugin"]
+        # Plugins are only imported when configured, so their dependencies
+        # are only needed (and paid for at startup) when used.
+        module_name = f"mqttdevice.plugins.{plugin}"
+        try:
+            plugin_module = importlib.import_module(module_name)
+        except ModuleNotFoundError as e:
+            if e.name != module_name:
+                raise
+            raise PluginNotFoundError(f"No such plugin {plugin}")
+        token = current_plugin.set(plugin_config["id"])
+        try:
             plugin_module.setup(self, plugin_config)
+        finally:
+            current_plugin.reset(token)
+        self.plugin_configs[plugin_config["id"]] = plugin_config
+        return self
+
+    async def unload_plugin(self, plugin_id: str):
+        for task in self._service_tasks.pop(plugin_id, []):
+            task.cancel()
+        self.services = [
+            (service, owner) for service, owner in self.services if owner != plugin_id
+        ]
+        for identifier in self.plugin_entities.pop(plugin_id, set()):
+            entity = self.entities.get(identifier)
+            if entity is None:
+                continue
+            try:
+                await self.retire_entity(entity)
+            except aiomqtt.MqttError as e:
+                logger.warning(f"Unable to publish removal of {identifier}: {e}")
+        self.plugin_configs.pop(plugin_id, None)
+
+    async def update_plugin(self, plugin_id: str, plugin_config: dict) -> bool:
+        # Applies a changed config to the plugin's entity in place, keeping
+        # its state. Only possible for plugins that are one entity configured
+        # by the plugin config itself, returns False for the others.
+        old = self.plugin_configs[plugin_id]
+        identifiers = self.plugin_entities.get(plugin_id, set())
+        if (
+            plugin_config["plugin"] != old["plugin"]
+            or len(identifiers) != 1
+            or any(owner == plugin_id for _, owner in self.services)
+        ):
+            return False
+        entity = self.entities[next(iter(identifiers))]
+        if entity.config is not old or not entity.reconfigure(plugin_config):
+            return False
+        self.plugin_configs[plugin_id] = plugin_config
+        if entity in self.scheduler:
+            # The polling interval may have changed
+            self.scheduler.remove(entity).add(entity)
+        if entity.connected or (self.shared_connection and self.connected):
+            try:
+                await entity.on_connect(entity.client)
+            except aiomqtt.MqttError as e:
+                logger.warning(f"Unable to publish update of {entity.identifier}: {e}")
+        logger.info(f"Updated plugin {entity.identifier}")
+        return True
+
+    async def reload(self, config: Config):
+        # Only plugins whose config changed are touched, everything else
+        # keeps its connection and state. Other settings need a restart.
+        for key in config.keys() | self.config.keys():
+            if key != "plugins" and config.get(key) != self.config.get(key):
+                logger.warning(f"Changing {key} needs a restart, ignoring it")
+        plugin_configs = {
+            plugin_config["id"]: plugin_config for plugin_config in config["plugins"]
+        }
+        for plugin_id, old in list(self.plugin_configs.items()):
+            new = plugin_configs.get(plugin_id)
+            if new == old:
+                continue
+            if new is not None and await self.update_plugin(plugin_id, new):
+                continue
+            await self.unload_plugin(plugin_id)
+            if new is not None:
+                self.start_plugin(new)
+        for plugin_id, new in plugin_configs.items():
+            if plugin_id not in self.plugin_configs:
+                self.start_plugin(new)
+        self.config["plugins"] = config["plugins"]
+
+    def start_plugin(self, plugin_config: dict):
+        try:
+            self.setup_plugin(plugin_config)
+        except PluginNotFoundError as e:
+            logger.error(e)
+            return
+        for identifier in self.plugin_entities.get(plugin_config["id"], set()):
+            self.start_entity(self.entities[identifier])
+        logger.info(f"Started plugin {plugin_config['id']}")
 
     def register_plugin(self, instance: Entity) -> typing.Self:
         instance.initialize_plugin(self)
         self.entities[instance.identifier] = instance
+        plugin_id = current_plugin.get()
+        if plugin_id is not None:
+            self.plugin_entities.setdefault(plugin_id, set()).add(instance.identifier)
         logger.info(f"Registered plugin {instance.identifier}")
         return self
 
+    def add_message_route(self, topic: str, entity: EntityWithMessage) -> typing.Self:
+        self.message_routes[topic] = entity
+        return self
+
+    def add_service(self, service: Service) -> typing.Self:
+        # Services are long running tasks, e.g. event listeners that create
+        # entities at runtime. They run for as long as the device loop does,
+        # or until their plugin is unloaded.
+        plugin_id = current_plugin.get()
+        self.services.append((service, plugin_id))
+        if self._task_group is not None:
+            self.start_service(service, plugin_id)
+        return self
+
+    def start_service(self, service: Service, plugin_id: str | None):
+        context = contextvars.copy_context()
+        context.run(current_plugin.set, plugin_id)
+        task = self._task_group.create_task(service(), context=context)
+        self._service_tasks.setdefault(plugin_id, []).append(task)
+
+    def start_entity(self, entity: Entity) -> typing.Self:
+        if self.shared_connection:
+            # Connects the entity to the current session, session() connects
+            # everything registered on the next one.
+            if self._session_group is None:
+                return self
+            task = self._session_group.create_task(self.run_entity(entity))
+        else:
+            if self._task_group is None:
+                return self
+            task = self._task_group.create_task(entity.loop())
+        self._entity_tasks[entity.identifier] = task
+        return self
+
+    async def run_entity(self, entity: Entity):
+        # One broken entity shouldn't end the session for every other one,
+        # only a lost connection does
+        try:
+            await entity.run(self.client)
+        except aiomqtt.MqttError:
+            raise
+        except Exception:
+            logger.exception(f"Error connecting {entity.identifier}")
+
+    async def retire_entity(self, entity: Entity):
+        self.scheduler.remove(entity)
+        task = self._entity_tasks.pop(entity.identifier, None)
+        if task is not None:
+            task.cancel()
+        self.dispatcher.forget(entity)
+        self.entities.pop(entity.identifier, None)
+        for identifiers in self.plugin_entities.values():
+            identifiers.discard(entity.identifier)
+        self.message_routes = {
+            topic: routed
+            for topic, routed in self.message_routes.items()
+            if routed is not entity
+        }
+        await entity.publish_removal(self.client)
+        logger.info(f"Retired plugin {entity.identifier}")
+
+    @property
+    def shared_connection(self) -> bool:
+        if self.gateway is not None:
+            return True
+        return bool(self._mqtt_config.get("shared_connection", True))
+
+    @property
+    def polling_interval(self) -> float:
+        return float(self.config.get("polling_interval", 60))
+
+    @property
+    def max_silence(self) -> float:
+        # Unchanged states are still republished at least this often
+        return float(self.config.get("max_silence", self.polling_interval * 10))
+
     @property
-    def polling_interval(self) -> int:
-        return int(self.config.get("polling_interval", 60))
+    def aggregate_state(self) -> bool:
+        # Publish every entity's state in one document on state_topic, rather
+        # than one message per entity
+        return bool(self.config.get("aggregate_state", False))
 
     @property
+    def discovery_prefix(self) -> str:
+        return self.config.get("discovery_prefix", "homeassistant")
+
+    @property
+    def device_discovery(self) -> bool:
+        # Publish one discovery payload for the device with every entity as a
+        # component, rather than one per entity. Needs Home Assistant 2024.11.
+        return bool(self.config.get("device_discovery", False))
+
+    @functools.cached_property
+    def discovery_topic(self) -> str:
+        return f"{self.discovery_prefix}/device/{self.name}/config"
+
+    @functools.cached_property
     def verbose_name(self) -> str:
         return self.config.get("device_name", titlecase(gethostname()))
 
-    @property
+    @functools.cached_property
     def name(self):
         return snakecase(self.verbose_name)
 
@@ -62,46 +343,341 @@ class Device(MQTTObject):
     def identifier(self) -> str:
         return self.name
 
-    @property
+    @functools.cached_property
     def device_metadata(self):
+        if self.gateway is not None:
+            return {
+                "ids": [f"{gethostname()}_{self.name}"],
+                "name": self.verbose_name,
+                "via_device": gethostname(),
+            }
         return {
             "ids": [gethostname(), uuid.getnode()],
             "name": self.verbose_name,
         }
 
-    def get_availability_state(self) -> bool:
-        return self.client._client.is_connected()
+    def get_shared_discovery_payload(self) -> dict:
+        availability = [
+            {
+                "topic": self.availability_topic,
+                "value_template": "{{ value_json.state }}",
+            }
+        ]
+        if self.gateway is not None:
+            # The gateway's connection carries the only will, so the device
+            # is only available while the gateway is too
+            availability.append(
+                {
+                    "topic": self.gateway.availability_topic,
+                    "value_template": "{{ value_json.state }}",
+                }
+            )
+        return {
+            "availability": availability,
+            "availability_mode": "latest" if self.gateway is None else "all",
+            "dev": self.device_metadata,
+            "o": {
+                "name": "MQTTDevice",
+                "url": "https://github.com/Azelphur/mqttdevice",
+            },
+        }
+
+    def get_discovery_payload(self) -> bytes:
+        # Uses https://www.home-assistant.io/integrations/mqtt/#device-discovery-payload
+        # The components' payloads are already serialized, so they are
+        # spliced in rather than decoded and dumped again
+        dumps = self.serializer.dumps
+        components = [
+            dumps(entity.id) + b":" + entity.discovery_payload
+            for entity in self.entities.values()
+        ]
+        # An entity recreated under the same id, e.g. by a reload, isn't
+        # removed. Home Assistant keeps the last of duplicate keys.
+        ids = {entity.id for entity in self.entities.values()}
+        components.extend(
+            dumps(id) + b":" + dumps({"p": domain})
+            for id, domain in self._removed_components.items()
+            if id not in ids
+        )
+        return self.shared_discovery_fragment + b',"cmps":{%s}}' % b",".join(components)
+
+    @functools.cached_property
+    def shared_discovery_fragment(self) -> bytes:
+        # The device payload up to its components, without the closing brace
+        return self.serializer.dumps(self.get_shared_discovery_payload())[:-1]
+
+    async def publish_discovery(self, force: bool = False):
+        if not self.connected or self._retained_discovery is None:
+            # The next session publishes it
+            return
+        async with self._discovery_lock:
+            if not self._retained_discovery.done():
+                # The broker sends the retained payload straight after the
+                # subscription, if there is one
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(self._retained_discovery), self.retained_timeout
+                    )
+                except TimeoutError:
+                    self._retained_discovery.set_result(None)
+            if self._discovery_subscribed:
+                # Otherwise every publish would be sent back to us
+                self._discovery_subscribed = False
+                await self.client.unsubscribe(self.discovery_topic)
+            payload = self.get_discovery_payload()
+            digest = hashlib.blake2b(payload, digest_size=16).digest()
+            if not force and digest == self._discovery_hash:
+                self.logger.debug("Discovery unchanged, not publishing")
+                return
+            await self.client.publish(self.discovery_topic, payload, retain=True)
+            self._discovery_hash = digest
+            self._removed_components.clear()
+            self.logger.info(f"Published discovery for {len(self.entities)} entities")
+
+    def schedule_discovery(self, force: bool = False):
+        # Entities change together (a session's resync, a plugin reload), so
+        # the payload is built and published once for all of them
+        self._discovery_forced |= force
+        if self._discovery_flush is None and self.connected:
+            self._discovery_flush = asyncio.create_task(self.flush_discovery())
+
+    async def flush_discovery(self):
+        await asyncio.sleep(self.scheduler.tick)
+        self._discovery_flush = None
+        force, self._discovery_forced = self._discovery_forced, False
+        try:
+            await self.publish_discovery(force)
+        except aiomqtt.MqttError as e:
+            # The next session publishes it
+            self.logger.warning(f"Unable to publish discovery: {e}")
+
+    def publish_component_removal(self, entity: Entity):
+        # Home Assistant removes a component that is left with only its
+        # platform, after that it can be left out
+        self._removed_components[entity.id] = entity.domain
+        self.schedule_discovery()
 
     @property
+    def retained_timeout(self) -> float:
+        # Seconds to wait for the broker to send a retained discovery payload
+        return float(self.config.get("retained_timeout", 1))
+
+    def get_availability_state(self) -> bool:
+        return self.connected
+
+    @functools.cached_property
     def availability_topic(self):
         return f"mqttdevice/{self.name}/availability"
 
-    async def publish_availability_state(self, client: aiomqtt.Client | None = None):
+    async def publish(
+        self,
+        topic: str,
+        payload: bytes,
+        client: aiomqtt.Client | None = None,
+        qos: int = 0,
+        retain: bool = False,
+        queue: bool = False,
+    ) -> bool:
+        # With queue, a publish that can't reach the broker is kept in the
+        # outbox until the next connection instead of raising. Returns whether
+        # it was published.
         client = client or self.client
-        payload = {"state": "online" if self.get_availability_state() else "offline"}
-        await client.publish(self.availability_topic, json.dumps(payload), retain=True)
-        self.logger.info(f"Published state: {json.dumps(json.dumps(payload))}")
+        if queue and not client._client.is_connected():
+            self.outbox.put(topic, payload, qos, retain)
+            return False
+        try:
+            await client.publish(topic, payload, qos=qos, retain=retain)
+        except aiomqtt.MqttError:
+            if not queue:
+                raise
+            self.outbox.put(topic, payload, qos, retain)
+            return False
+        self.outbox.discard(topic)
+        return True
 
-    async def on_connect(self, client: aiomqtt.Client):
-        await self.publish_availability_state(client)
-        self.will_set(
-            self.availability_topic,
-            json.dumps({"state": "offline"}),
-            retain=True,
+    @functools.cached_property
+    def state_topic(self) -> str:
+        return f"mqttdevice/{self.name}/state"
+
+    def stage_state(self, entity: EntityWithState, payload: bytes | None):
+        # None removes the entity from the state
+        if payload is None:
+            self.states.pop(entity.id, None)
+        else:
+            self.states[entity.id] = payload
+        self._state_staged = time.monotonic()
+        if self._state_flush is None:
+            self._state_flush = asyncio.create_task(self.flush_state())
+
+    async def flush_state(self):
+        # A poll's states go out as one message: it's sent once nothing has
+        # been staged for a tick, or after at most one polling interval when
+        # states keep coming
+        deadline = time.monotonic() + max(self.polling_interval, self.scheduler.tick)
+        while True:
+            await asyncio.sleep(self.scheduler.tick)
+            now = time.monotonic()
+            if now - self._state_staged >= self.scheduler.tick or now >= deadline:
+                break
+        self._state_flush = None
+        # The entities' payloads are already serialized, so they are spliced
+        # in rather than decoded and dumped again
+        dumps = self.serializer.dumps
+        payload = b"{%s}" % b",".join(
+            dumps(id) + b":" + state for id, state in self.states.items()
         )
+        if await self.publish(self.state_topic, payload, retain=True, queue=True):
+            self.publish_count += 1
+            self.logger.debug(f"Published {len(self.states)} states")
+
+    @functools.cached_property
+    def diagnostics_topic(self) -> str:
+        return f"mqttdevice/{self.name}/diagnostics"
+
+    def collect_metrics(self, metrics: Metrics):
+        metrics.set("mqttdevice_outbox_size", len(self.outbox))
+        metrics.set("mqttdevice_outbox_dropped_total", self.outbox.dropped)
+
+    async def publish_diagnostics(self):
+        while True:
+            await asyncio.sleep(self.metrics.interval)
+            if not self.connected:
+                continue
+            payload = self.serializer.dumps(self.metrics.snapshot())
+            try:
+                await self.client.publish(self.diagnostics_topic, payload, retain=True)
+            except aiomqtt.MqttError as e:
+                self.logger.warning(f"Unable to publish diagnostics: {e}")
+
+    async def publish_availability_state(
+        self, client: aiomqtt.Client | None = None, force: bool = False
+    ):
+        client = client or self.client
+        payload = self.availability_payloads[bool(self.get_availability_state())]
+        if (
+            not force
+            and payload == self._last_availability
+            and time.monotonic() - self._last_availability_published < self.max_silence
+        ):
+            self.suppressed_count += 1
+            return
+        await client.publish(self.availability_topic, payload, retain=True)
+        self._last_availability = payload
+        self._last_availability_published = time.monotonic()
+        self.publish_count += 1
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(f"Published state: {payload.decode()}")
+
+    @property
+    def status_topic(self) -> str:
+        # Home Assistant's birth and last will topic
+        return f"{self.discovery_prefix}/status"
+
+    async def republish_discovery(self):
+        if self.device_discovery:
+            await self.publish_discovery(force=True)
+            return
+        for entity in list(self.entities.values()):
+            await entity.publish_discovery(force=True)
+
+    async def on_connect(self, client: aiomqtt.Client):
+        await self.publish_availability_state(client, force=True)
+        await client.subscribe(self.status_topic)
+        if self.device_discovery:
+            # Compared with what the broker already has, so a restart with
+            # the same entities doesn't publish discovery again
+            self._discovery_hash = None
+            self._retained_discovery = asyncio.get_running_loop().create_future()
+            await client.subscribe(self.discovery_topic)
+            self._discovery_subscribed = True
 
     async def on_loop(self, client: aiomqtt.Client):
-        await self.publish_availability_state(client)
+        if self.connected:
+            await self.publish_availability_state(client)
 
     async def on_disconnect(self):
         pass
 
+    async def on_message(self, message: Message):
+        if message.topic.value == self.status_topic:
+            # Home Assistant restarted and may have lost retained discovery
+            if message.payload == b"online" and not message.retain:
+                await self.republish_discovery()
+            return
+        if self.device_discovery and message.topic.value == self.discovery_topic:
+            if message.retain and not self._retained_discovery.done():
+                if message.payload:
+                    self._discovery_hash = hashlib.blake2b(
+                        message.payload, digest_size=16
+                    ).digest()
+                self._retained_discovery.set_result(message.payload)
+            return
+        entity = self.message_routes.get(message.topic.value)
+        if entity is None:
+            self.logger.debug(f"No entity subscribed to {message.topic}")
+            return
+        # Handled in a task, so a slow handler doesn't hold up other messages
+        self.dispatcher.dispatch(entity, message)
+
+    def routes(self, topic: str) -> bool:
+        # Whether on_message handles messages on topic
+        return (
+            topic == self.status_topic
+            or topic in self.message_routes
+            or (self.device_discovery and topic == self.discovery_topic)
+        )
+
+    async def route_messages(self, client: aiomqtt.Client):
+        async for message in client.messages:
+            await self.on_message(message)
+
+    async def session(self, client: aiomqtt.Client):
+        await self.on_connect(client)
+        try:
+            async with asyncio.TaskGroup() as tg:
+                self._session_group = tg
+                if self.gateway is None:
+                    tg.create_task(self.route_messages(client))
+                else:
+                    # The gateway routes messages, this keeps the session
+                    # open for entities started while it lasts
+                    tg.create_task(asyncio.Event().wait())
+                if self.device_discovery:
+                    self.schedule_discovery()
+                if self.shared_connection:
+                    # Entities republish discovery if it changed and flush
+                    # their state straight away, rather than after a
+                    # polling interval
+                    for entity in list(self.entities.values()):
+                        self.start_entity(entity)
+                    if self._entity_tasks:
+                        await asyncio.wait(list(self._entity_tasks.values()))
+                if self.gateway is None:
+                    # Whatever the resync didn't supersede
+                    tg.create_task(self.outbox.drain(client))
+        finally:
+            self._session_group = None
+            if self.shared_connection:
+                self._entity_tasks.clear()
+
+    def start(self, tg: asyncio.TaskGroup):
+        # Starts the services and polling, which run in tg from then on
+        self._task_group = tg
+        for service, plugin_id in self.services:
+            self.start_service(service, plugin_id)
+        if not self.shared_connection:
+            for entity in list(self.entities.values()):
+                self.start_entity(entity)
+        self.scheduler.add(self)
+
     async def loop(self):
         print(f"Starting loop for {self.identifier}")
-        async with self.client as client:
-            await self.on_connect(client)
-            while True:
-                self.logger.debug(f"Running loop for {self.identifier}")
-                await asyncio.sleep(self.polling_interval)
-                self.logger.debug(f"Running loop for {self.identifier}")
-                await self.on_loop(client)
+        # Polling and services carry on while the broker is unreachable,
+        # state changes are queued in the outbox until the next session.
+        try:
+            async with asyncio.TaskGroup() as tg:
+                self.start(tg)
+                tg.create_task(self.scheduler.run())
+                await self.supervise(self.session)
+        finally:
+            self.outbox.flush()
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+    from aiomqtt.client import Message
+
+    from mqttdevice.entities.entity import EntityWithMessage
+    from mqttdevice.metrics import Metrics
+
+logger = logging.getLogger("mqttdevice.dispatcher")
+
+
+class CommandDispatcher:
+    """Runs entities' message handlers in tasks as messages arrive.
+
+    A slow handler only holds up its own entity, which runs at most
+    max_handlers handlers at once. Retained commands, which the broker sends
+    again on every subscribe, are dropped. The session is clean, so nothing
+    is redelivered across reconnects, and paho already delivers QoS 2
+    messages exactly once.
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        # Entity identifier -> handler limit and the semaphore enforcing it
+        self._semaphores: dict[str, tuple[int, asyncio.Semaphore]] = dict()
+        self._tasks: dict[str, set[asyncio.Task]] = dict()
+
+    def get_semaphore(self, entity: EntityWithMessage) -> asyncio.Semaphore:
+        limit = entity.max_handlers
+        current = self._semaphores.get(entity.identifier)
+        if current is None or current[0] != limit:
+            # Handlers already running keep the semaphore they started with
+            current = self._semaphores[entity.identifier] = (
+                limit,
+                asyncio.Semaphore(limit),
+            )
+        return current[1]
+
+    def dispatch(self, entity: EntityWithMessage, message: Message):
+        received = time.perf_counter()
+        if message.retain:
+            entity.logger.info("Dropping retained command")
+            self.metrics.inc(
+                "mqttdevice_commands_dropped_total", entity=entity.identifier
+            )
+            return
+        task = asyncio.create_task(
+            self.handle(entity, message, self.get_semaphore(entity), received)
+        )
+        tasks = self._tasks.setdefault(entity.identifier, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def handle(
+        self,
+        entity: EntityWithMessage,
+        message: Message,
+        semaphore: asyncio.Semaphore,
+        received: float,
+    ):
+        async with semaphore:
+            # From the message coming off the connection to its handler
+            # starting, including any wait behind the entity's other handlers
+            self.metrics.observe(
+                "mqttdevice_command_latency_seconds",
+                time.perf_counter() - received,
+                entity=entity.identifier,
+            )
+            try:
+                await entity.on_message(message)
+            except Exception:
+                entity.logger.exception("Error handling message")
+
+    def forget(self, entity: EntityWithMessage):
+        # The entity is gone, so are its queued and running handlers
+        for task in self._tasks.pop(entity.identifier, set()):
+            task.cancel()
+        self._semaphores.pop(entity.identifier, None)
@@ -1,14 +1,16 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from typing import ClassVar, Literal
-
-from homeassistant.components.binary_sensor import BinarySensorDeviceClass, DOMAIN
+from typing import Awaitable, ClassVar, Literal
 
+from mqttdevice.const import BINARY_SENSOR_DOMAIN as DOMAIN
+from mqttdevice.const import BinarySensorDeviceClass
 from mqttdevice.entities.entity import EntityWithState
 
 
 class BinarySensor(EntityWithState, ABC):
+    __slots__ = ()
+
     domain = DOMAIN
     device_class: ClassVar[BinarySensorDeviceClass | None] = None
 
@@ -16,5 +18,5 @@ class BinarySensor(EntityWithState, ABC):
         return "ON" if state else "OFF"
 
     @abstractmethod
-    def get_state(self) -> bool:
+    def get_state(self) -> bool | Awaitable[bool]:
         raise NotImplementedError
@@ -1,28 +1,40 @@
 from __future__ import annotations
 
 from abc import ABC
-from typing import ClassVar
+from typing import ClassVar, Self
 
 import aiomqtt
-from homeassistant.components.button import ButtonDeviceClass, DOMAIN
-
+from mqttdevice.const import BUTTON_DOMAIN as DOMAIN
+from mqttdevice.const import ButtonDeviceClass
 from mqttdevice.entities.entity import EntityWithMessage
 
 
 class Button(EntityWithMessage, ABC):
+    __slots__ = ("set_topic",)
+
     domain = DOMAIN
     device_class: ClassVar[ButtonDeviceClass | None] = None
 
-    @property
-    def set_topic(self):
-        return f"mqttdevice/{self.identifier}/set"
+    # Set by freeze()
+    set_topic: str
+
+    def freeze(self) -> Self:
+        self.set_topic = f"mqttdevice/{self.identifier}/set"
+        return super().freeze()
 
-    async def publish_discovery(self, client: aiomqtt.Client | None = None):
+    async def publish_discovery(
+        self, client: aiomqtt.Client | None = None, force: bool = False
+    ):
         client = client or self.client
-        await super().publish_discovery(client)
-        await client.subscribe(self.set_topic)
+        await super().publish_discovery(client, force)
+        # Subscribe even when discovery is unchanged, a new session may not
+        # have kept the subscription.
+        await client.subscribe(self.set_topic, qos=self.qos)
+        self.device.add_message_route(self.set_topic, self)
 
     def get_discovery_payload(self):
         payload = super().get_discovery_payload()
         payload["command_topic"] = self.set_topic
+        if self.qos:
+            payload["qos"] = self.qos
         return payload
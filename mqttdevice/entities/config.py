@@ -7,4 +7,11 @@ class PluginConfig(TypedDict):
     id: str
     name: str | None
     plugin: str
-    polling_interval: int | None
+    polling_interval: float | None
+    probe_timeout: float | None
+    max_silence: float | None
+    deadband: float | None
+    sample_rate: float | None
+    statistic: str | None
+    qos: int | None
+    max_handlers: int | None
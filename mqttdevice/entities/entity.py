@@ -1,22 +1,51 @@
 from __future__ import annotations
 
 import asyncio
-import json
+import inspect
+import logging
+import sys
+import time
 from abc import ABC, abstractmethod
 from enum import StrEnum
-from typing import TYPE_CHECKING, Any, ClassVar, Self
+from typing import TYPE_CHECKING, Any, Awaitable, ClassVar, Self
 
 import aiomqtt
 from aiomqtt.client import Message
 
 from mqttdevice.entities.config import PluginConfig
+from mqttdevice.exceptions import ProbeError
 from mqttdevice.mqtt_object import MQTTObject
 
 if TYPE_CHECKING:
     from mqttdevice.device import Device
+    from mqttdevice.metrics import Metrics
+
+logger = logging.getLogger("mqttdevice.entities")
+
+
+class EntityLogger(logging.LoggerAdapter):
+    # Entities share one logger rather than each registering their own, the
+    # entity's identifier is prefixed to the message instead.
+    def __init__(self, logger: logging.Logger, entity: Entity):
+        super().__init__(logger)
+        self.entity = entity
+
+    def process(self, msg, kwargs):
+        return f"{self.entity.identifier}: {msg}", kwargs
 
 
 class Entity(MQTTObject, ABC):
+    # Entities are created by the thousand in gateways, so they don't get a
+    # __dict__. Subclasses must declare __slots__ too, empty if they add no
+    # attributes, for this to hold.
+    __slots__ = (
+        "config",
+        "_device",
+        "discovery_topic",
+        "discovery_payload",
+        "_published_discovery",
+    )
+
     default_name: ClassVar[str | None] = None
     config: PluginConfig
     domain: ClassVar[str]
@@ -25,10 +54,48 @@ class Entity(MQTTObject, ABC):
 
     _device: Device
 
+    # Set by freeze()
+    discovery_topic: str
+    discovery_payload: bytes
+
+    # The discovery payload the broker has retained, as far as we know
+    _published_discovery: bytes | None
+
     def __init__(self, device: Device, config: PluginConfig, *args, **kwargs):
         self.config = config
+        self._published_discovery = None
         device.register_plugin(self)
-        super().__init__(self.device._mqtt_config, *args, **kwargs)
+        client = self.device.client if self.device.shared_connection else None
+        super().__init__(self.device._mqtt_config, client, *args, **kwargs)
+        self.freeze()
+
+    def freeze(self) -> Self:
+        # Topics and the discovery payload only depend on the config, so they
+        # are built once here rather than on every publish. Call again after
+        # changing the config.
+        if self.device.device_discovery:
+            # Published as one of the components of the device's payload
+            self.discovery_topic = self.device.discovery_topic
+            self.discovery_payload = self.device.serializer.dumps(
+                self.get_component_payload()
+            )
+            return self
+        self.discovery_topic = (
+            f"{self.device.discovery_prefix}/{self.domain}/{self.device.name}/{self.id}/config"
+        )
+        self.discovery_payload = self.device.serializer.dumps(
+            self.get_discovery_payload()
+        )
+        return self
+
+    def reconfigure(self, config: PluginConfig) -> bool:
+        # Applies a changed config in place, returns False if the entity has
+        # to be recreated instead
+        if config["id"].lower() != self.id:
+            return False
+        self.config = config
+        self.freeze()
+        return True
 
     @property
     def id(self) -> str:
@@ -43,13 +110,20 @@ class Entity(MQTTObject, ABC):
         return f"{self.device.name}_{self.id}"
 
     @property
-    def polling_interval(self) -> int:
-        return int(self.config.get("polling_interval", self.device.polling_interval))
+    def polling_interval(self) -> float:
+        return float(self.config.get("polling_interval", self.device.polling_interval))
+
+    def _get_logger(self) -> EntityLogger:
+        return EntityLogger(logger, self)
 
     def initialize_plugin(self, device: Device) -> Self:
         self._device = device
         return self
 
+    @property
+    def metrics(self) -> Metrics:
+        return self.device.metrics
+
     @property
     def device(self) -> Device:
         try:
@@ -57,35 +131,42 @@ class Entity(MQTTObject, ABC):
         except AttributeError:
             raise AttributeError("Plugin not initialized yet.")
 
-    async def publish_discovery(self, client: aiomqtt.Client | None = None):
+    async def publish_discovery(
+        self, client: aiomqtt.Client | None = None, force: bool = False
+    ):
+        if self.device.device_discovery:
+            self.device.schedule_discovery(force)
+            return
         client = client or self.client
-        payload = self.get_discovery_payload()
-        self.logger.debug(f"Publishing discovery: {payload}")
-        await client.publish(self.discovery_topic, json.dumps(payload), retain=True)
+        if not force and self.discovery_payload == self._published_discovery:
+            self.logger.debug("Discovery unchanged, not publishing")
+            return
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                f"Publishing discovery: {self.discovery_payload.decode()}"
+            )
+        await client.publish(self.discovery_topic, self.discovery_payload, retain=True)
+        self._published_discovery = self.discovery_payload
         self.logger.info("Published discovery")
 
-    @property
-    def discovery_topic(self):
-        return f"homeassistant/{self.domain}/{self.device.name}/{self.id}/config"
+    async def publish_removal(self, client: aiomqtt.Client | None = None):
+        if self.device.device_discovery:
+            self.device.publish_component_removal(self)
+            return
+        # An empty retained config removes the entity from Home Assistant
+        client = client or self.client
+        await client.publish(self.discovery_topic, b"", retain=True)
+        self._published_discovery = None
+        self.logger.info("Published removal")
 
     def get_discovery_payload(self):
         # Uses https://www.home-assistant.io/integrations/mqtt/#single-component-discovery-payload
-        payload = {
-            "availability": [
-                {
-                    "topic": f"mqttdevice/{self.device.name}/availability",
-                    "value_template": "{{ value_json.state }}",
-                }
-            ],
-            "availability_mode": "latest",
-            "unique_id": self.id,
-            "object_id": self.identifier,
-            "dev": self.device.device_metadata,
-            "o": {
-                "name": "MQTTDevice",
-                "url": "https://github.com/Azelphur/mqttdevice",
-            },
-        }
+        payload = self.device.get_shared_discovery_payload()
+        # Ids are only unique per device, and a gateway hosts several
+        payload["unique_id"] = (
+            self.id if self.device.gateway is None else self.identifier
+        )
+        payload["object_id"] = self.identifier
         if self.name:
             payload["name"] = self.name
         if self.device_class:
@@ -100,6 +181,16 @@ class Entity(MQTTObject, ABC):
                 payload["unit_of_measurement"] = self.unit_of_measurement
         return payload
 
+    def get_component_payload(self) -> dict:
+        # The discovery payload without what the device's payload already
+        # has for every component
+        shared = self.device.get_shared_discovery_payload()
+        payload = {"p": self.domain}
+        for key, value in self.get_discovery_payload().items():
+            if key not in shared:
+                payload[key] = value
+        return payload
+
     async def on_connect(self, client: aiomqtt.Client):
         await self.publish_discovery(client)
 
@@ -109,30 +200,113 @@ class Entity(MQTTObject, ABC):
     async def on_disconnect(self, client: aiomqtt.Client):
         pass
 
+    async def run(self, client: aiomqtt.Client):
+        try:
+            await self.on_connect(client)
+        finally:
+            # From here on the device's scheduler calls on_loop, which also
+            # retries a connect that failed
+            self.device.scheduler.add(self)
+
+    async def session(self, client: aiomqtt.Client):
+        await self.run(client)
+        # Nothing is subscribed, this just raises when the connection drops
+        async for _ in client.messages:
+            pass
+
     async def loop(self):
         print("Starting loop")
-        async with self.client as client:
-            await self.on_connect(client)
-            while True:
-                self.logger.debug(f"Sleeping for {self.polling_interval} seconds")
-                await asyncio.sleep(self.polling_interval)
-                self.logger.debug("Running loop")
-                await self.on_loop(client)
-            await self.on_disconnect(client)
+        await self.supervise(self.session)
 
 
 class EntityWithState(Entity, ABC):
+    __slots__ = (
+        "state_key",
+        "state_topic",
+        "value_template",
+        "_last_state",
+        "_last_payload",
+        "_last_published",
+        "publish_count",
+        "suppressed_count",
+    )
+
+    # Set by freeze()
+    state_key: str
+    state_topic: str
+    value_template: str
+
+    _last_state: Any
+    _last_payload: bytes | None
+    _last_published: float
+    publish_count: int
+    suppressed_count: int
+
+    def __init__(self, device: Device, config: PluginConfig, *args, **kwargs):
+        self._last_state = None
+        self._last_payload = None
+        self._last_published = 0.0
+        self.publish_count = 0
+        self.suppressed_count = 0
+        super().__init__(device, config, *args, **kwargs)
+
     @abstractmethod
-    def get_state(self) -> Any:
+    def get_state(self) -> Any | Awaitable[Any]:
         raise NotImplementedError
-    
+
+    @property
+    def probe_timeout(self) -> float | None:
+        return self.config.get("probe_timeout")
+
+    async def read_state(self) -> Any:
+        start = time.perf_counter()
+        # get_state may be a coroutine, anything else is run in the probe pool
+        # so that a slow probe can't block the event loop.
+        if inspect.iscoroutinefunction(self.get_state):
+            state = await self.device.probes.wait_for(
+                self.get_state(), self.probe_timeout
+            )
+        else:
+            state = await self.device.probes.run_in_thread(
+                self.get_state, timeout=self.probe_timeout
+            )
+        self.metrics.observe(
+            "mqttdevice_probe_seconds",
+            time.perf_counter() - start,
+            entity=self.identifier,
+        )
+        return state
+
     def format_state(self, state: Any) -> Any:
         return state
 
-    @property
-    def state_topic(self):
-        device_class = (self.device_class.value if isinstance(self.device_class, StrEnum) else self.device_class) or "state"
-        return f"mqttdevice/{self.identifier}/{device_class}"
+    def freeze(self) -> Self:
+        # The key and template are the same for every entity of a class, so
+        # interning them keeps one copy
+        self.state_key = sys.intern(
+            (
+                self.device_class.value
+                if isinstance(self.device_class, StrEnum)
+                else self.device_class
+            )
+            or "state"
+        )
+        if self.device.aggregate_state:
+            self.state_topic = self.device.state_topic
+        else:
+            self.state_topic = f"mqttdevice/{self.identifier}/{self.state_key}"
+        self.value_template = sys.intern(self.get_value_template(self.state_key))
+        return super().freeze()
+
+    def get_value_template(self, key: str) -> str:
+        # The template for a key of the state payload, which is nested under
+        # the entity's id in the device's state when it is aggregated
+        if self.device.aggregate_state:
+            return f"{{{{ value_json[{self.id!r}].{key} }}}}"
+        return f"{{{{ value_json.{key} }}}}"
+
+    def get_state_payload(self, state: Any) -> dict:
+        return {self.state_key: self.format_state(state)}
 
     def get_discovery_payload(self):
         payload = super().get_discovery_payload()
@@ -141,20 +315,67 @@ class EntityWithState(Entity, ABC):
         return payload
 
     @property
-    def value_template(self):
-        device_class = (self.device_class.value if isinstance(self.device_class, StrEnum) else self.device_class) or "state"
-        return f"{{{{ value_json.{device_class} }}}}"
-    
-    async def publish_state(self, client: aiomqtt.Client | None = None) -> None:
+    def max_silence(self) -> float:
+        return float(self.config.get("max_silence", self.device.max_silence))
+
+    def has_changed(self, state: Any, payload: bytes) -> bool:
+        return payload != self._last_payload
+
+    def should_publish(self, state: Any, payload: bytes) -> bool:
+        if self._last_payload is None:
+            return True
+        # Republish unchanged states now and then as a heartbeat
+        if time.monotonic() - self._last_published >= self.max_silence:
+            return True
+        return self.has_changed(state, payload)
+
+    async def publish_state(
+        self, client: aiomqtt.Client | None = None, force: bool = False
+    ) -> None:
         client = client or self.client
-        device_class = (self.device_class.value if isinstance(self.device_class, StrEnum) else self.device_class) or "state"
-        payload = {device_class: self.format_state(self.get_state())}
-        await client.publish(self.state_topic, json.dumps(payload), retain=True)
-        self.logger.info(f"Published state: {json.dumps(payload)}")
+        try:
+            state = await self.read_state()
+        except ProbeError as e:
+            self.logger.warning(f"Not publishing state: {e}")
+            return
+        payload = self.device.serializer.dumps(self.get_state_payload(state))
+        if not force and not self.should_publish(state, payload):
+            self.suppressed_count += 1
+            self.metrics.inc(
+                "mqttdevice_publishes_suppressed_total", entity=self.identifier
+            )
+            self.logger.debug("State unchanged, not publishing")
+            return
+        if self.device.aggregate_state:
+            self.device.stage_state(self, payload)
+        elif not await self.device.publish(
+            self.state_topic, payload, client, retain=True, queue=True
+        ):
+            self.logger.info("Broker unreachable, queued state")
+            return
+        self._last_state = state
+        self._last_payload = payload
+        self._last_published = time.monotonic()
+        self.publish_count += 1
+        self.metrics.inc("mqttdevice_publishes_total", entity=self.identifier)
+        self.metrics.inc(
+            "mqttdevice_publish_bytes_total", len(payload), entity=self.identifier
+        )
+        if self.logger.isEnabledFor(logging.INFO):
+            # Only decoded when it is logged
+            self.logger.info(f"Published state: {payload.decode()}")
+
+    async def publish_removal(self, client: aiomqtt.Client | None = None):
+        client = client or self.client
+        await super().publish_removal(client)
+        if self.device.aggregate_state:
+            self.device.stage_state(self, None)
+        else:
+            await client.publish(self.state_topic, b"", retain=True)
 
     async def on_connect(self, client: aiomqtt.Client):
         await super().on_connect(client)
-        await self.publish_state(client)
+        await self.publish_state(client, force=True)
 
     async def on_loop(self, client: aiomqtt.Client):
         await super().on_loop(client)
@@ -166,11 +387,26 @@ class EntityWithState(Entity, ABC):
 
 
 class EntityWithMessage(Entity, ABC):
+    __slots__ = ()
+
     @abstractmethod
     async def on_message(self, message: Message) -> Any: ...
 
-    async def loop(self):
-        async with self.client as client:
-            await self.on_connect(client)
-            async for message in client.messages:
-                await self.on_message(message)
+    @property
+    def qos(self) -> int:
+        # Of the subscription, and of the commands Home Assistant publishes
+        return int(self.config.get("qos", 0))
+
+    @property
+    def max_handlers(self) -> int:
+        # Messages handled at once, later ones wait for a handler to finish
+        return int(self.config.get("max_handlers", 1))
+
+    async def run(self, client: aiomqtt.Client):
+        # Messages are routed to on_message by the device on a shared connection
+        await self.on_connect(client)
+
+    async def session(self, client: aiomqtt.Client):
+        await self.run(client)
+        async for message in client.messages:
+            self.device.dispatcher.dispatch(self, message)
@@ -1,13 +1,139 @@
 from __future__ import annotations
 
-from abc import ABC
-from typing import ClassVar
-
-from homeassistant.components.sensor import SensorDeviceClass, DOMAIN
+import asyncio
+import math
+from abc import ABC, abstractmethod
+from array import array
+from typing import TYPE_CHECKING, Any, ClassVar, Self
 
+from mqttdevice.const import SENSOR_DOMAIN as DOMAIN
+from mqttdevice.const import SensorDeviceClass
 from mqttdevice.entities.entity import EntityWithState
 
+if TYPE_CHECKING:
+    from mqttdevice.device import Device
+    from mqttdevice.entities.config import PluginConfig
+
 
 class Sensor(EntityWithState, ABC):
+    __slots__ = ()
+
     domain = DOMAIN
     device_class: ClassVar[SensorDeviceClass | None] = None
+
+    @property
+    def deadband(self) -> float:
+        return float(self.config.get("deadband", 0))
+
+    def has_changed(self, state: Any, payload: bytes) -> bool:
+        if (
+            self.deadband
+            and isinstance(state, (int, float))
+            and isinstance(self._last_state, (int, float))
+        ):
+            return abs(state - self._last_state) >= self.deadband
+        return super().has_changed(state, payload)
+
+
+class StreamingSensor(Sensor, ABC):
+    """Samples at sample_rate and publishes once per polling_interval.
+
+    Samples go into a ring buffer of doubles that holds one reporting window,
+    and each publish reports the window's min, max, mean and last sample, so
+    the load on the broker doesn't grow with the sample rate. The state is
+    the statistic configured (mean by default), the rest are attributes.
+    """
+
+    __slots__ = ("samples", "sample_index", "sample_count")
+
+    samples: array
+    # Position of the next sample, and samples taken since the last publish
+    sample_index: int
+    sample_count: int
+
+    def __init__(self, device: Device, config: PluginConfig, *args, **kwargs):
+        super().__init__(device, config, *args, **kwargs)
+        self.device.add_service(self.sample_loop)
+
+    @property
+    def sample_rate(self) -> float:
+        # Samples per second
+        return float(self.config.get("sample_rate", 10))
+
+    @property
+    def statistic(self) -> str:
+        return self.config.get("statistic", "mean")
+
+    def freeze(self) -> Self:
+        # Sized to hold one reporting window, or a second's worth for
+        # sensors that aren't polled
+        window = self.polling_interval if self.polling_interval > 0 else 1
+        size = max(1, math.ceil(self.sample_rate * window))
+        self.samples = array("d", [0.0]) * size
+        self.sample_index = 0
+        self.sample_count = 0
+        return super().freeze()
+
+    @abstractmethod
+    def get_sample(self) -> float | None:
+        # Called on the event loop sample_rate times a second, so it mustn't
+        # block. None skips the sample.
+        raise NotImplementedError
+
+    def add_sample(self, value: float):
+        self.samples[self.sample_index] = value
+        self.sample_index = (self.sample_index + 1) % len(self.samples)
+        self.sample_count += 1
+
+    async def sample_loop(self):
+        loop = asyncio.get_running_loop()
+        due = loop.time()
+        while True:
+            try:
+                value = self.get_sample()
+            except Exception:
+                self.logger.exception("Error sampling")
+                value = None
+            if value is not None:
+                self.add_sample(value)
+            # Against a fixed clock so the time spent sampling doesn't lower
+            # the rate, samples that are already late are skipped
+            due += 1 / self.sample_rate
+            now = loop.time()
+            if due < now:
+                due = now
+            await asyncio.sleep(due - now)
+
+    def get_window(self) -> array:
+        # The samples taken since the last publish, oldest first, at most one
+        # buffer's worth
+        size = len(self.samples)
+        count = min(self.sample_count, size)
+        start = (self.sample_index - count) % size
+        if start + count <= size:
+            return self.samples[start : start + count]
+        return self.samples[start:] + self.samples[: self.sample_index]
+
+    async def get_state(self) -> dict[str, float] | None:
+        window = self.get_window()
+        self.sample_count = 0
+        if not window:
+            return None
+        return {
+            "min": min(window),
+            "max": max(window),
+            "mean": math.fsum(window) / len(window),
+            "last": window[-1],
+            "samples": len(window),
+        }
+
+    def get_state_payload(self, state: dict[str, float] | None) -> dict:
+        payload = super().get_state_payload(state[self.statistic] if state else None)
+        payload["stats"] = state
+        return payload
+
+    def get_discovery_payload(self):
+        payload = super().get_discovery_payload()
+        payload["json_attributes_topic"] = self.state_topic
+        payload["json_attributes_template"] = self.get_value_template("stats")
+        return payload
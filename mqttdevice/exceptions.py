@@ -1,2 +1,22 @@
 class WillAlreadySetError(Exception):
     pass
+
+
+class ProbeError(Exception):
+    pass
+
+
+class ProbeTimeoutError(ProbeError):
+    pass
+
+
+class PluginNotFoundError(Exception):
+    pass
+
+
+class DeviceExistsError(Exception):
+    pass
+
+
+class ShardError(ProbeError):
+    pass
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+
+import aiomqtt
+from caseconverter import snakecase
+
+from mqttdevice.device import Config, Device
+from mqttdevice.exceptions import DeviceExistsError
+from mqttdevice.metrics import Metrics
+
+logger = logging.getLogger("mqttdevice.gateway")
+
+# Settings that configure the shared connection and executors rather than a
+# device, so devices don't inherit them
+GATEWAY_KEYS = {
+    "devices",
+    "plugins",
+    "device_name",
+    "mqtt",
+    "probes",
+    "scheduler",
+    "outbox",
+    "metrics",
+    "serializer",
+}
+
+
+class GatewayConfig(Config):
+    devices: list[Config]
+
+
+class Gateway(Device):
+    """Hosts many devices in one process, over one connection.
+
+    The devices share the gateway's client, scheduler, probes, metrics and
+    outbox, so each one costs its entities and a few KB. The gateway is a
+    device itself, with its own (optional) plugins and availability. The
+    broker only takes one will per connection, so devices are available while
+    both they and the gateway are.
+    """
+
+    def __init__(self, config: GatewayConfig):
+        super().__init__({"plugins": [], **config})
+        self.devices: dict[str, Device] = dict()
+        self._device_sessions: dict[str, asyncio.Task] = dict()
+        self._devices_group: asyncio.TaskGroup | None = None
+        for device_config in config["devices"]:
+            try:
+                self.add_device(device_config)
+            except DeviceExistsError as e:
+                logger.error(e)
+                sys.exit(1)
+
+    def get_device_config(self, device_config: Config) -> Config:
+        # Device settings such as polling_interval default to the gateway's
+        shared = {
+            key: value for key, value in self.config.items() if key not in GATEWAY_KEYS
+        }
+        return {**shared, **device_config}
+
+    def add_device(self, device_config: Config) -> Device:
+        identifier = snakecase(device_config["device_name"])
+        if identifier == self.identifier or identifier in self.devices:
+            raise DeviceExistsError(f"Device {identifier} is configured twice")
+        device = Device(self.get_device_config(device_config), gateway=self)
+        self.devices[identifier] = device
+        logger.info(f"Added device {identifier}")
+        return device
+
+    def start_device(self, device: Device):
+        # Starts a device added after the gateway started
+        if self._task_group is not None:
+            device.start(self._task_group)
+        if self._devices_group is not None:
+            self.start_device_session(device)
+
+    async def remove_device(self, identifier: str):
+        device = self.devices.pop(identifier)
+        task = self._device_sessions.pop(identifier, None)
+        if task is not None:
+            task.cancel()
+        for plugin_id in list(device.plugin_configs):
+            await device.unload_plugin(plugin_id)
+        self.scheduler.remove(device)
+        if self.connected:
+            try:
+                await self.client.publish(
+                    device.availability_topic,
+                    device.availability_payloads[False],
+                    retain=True,
+                )
+            except aiomqtt.MqttError as e:
+                logger.warning(f"Unable to publish removal of {identifier}: {e}")
+        logger.info(f"Removed device {identifier}")
+
+    async def reload(self, config: GatewayConfig):
+        # Devices are added, removed and reloaded by name
+        await super().reload({**config, "devices": self.config.get("devices")})
+        configs = {
+            snakecase(device_config["device_name"]): device_config
+            for device_config in config.get("devices", [])
+        }
+        for identifier, device in list(self.devices.items()):
+            if identifier not in configs:
+                await self.remove_device(identifier)
+            else:
+                await device.reload(self.get_device_config(configs[identifier]))
+        for identifier, device_config in configs.items():
+            if identifier in self.devices:
+                continue
+            try:
+                self.start_device(self.add_device(device_config))
+            except DeviceExistsError as e:
+                logger.error(e)
+        self.config["devices"] = config.get("devices", [])
+
+    def start(self, tg: asyncio.TaskGroup):
+        super().start(tg)
+        for device in self.devices.values():
+            device.start(tg)
+
+    def start_device_session(self, device: Device):
+        task = self._devices_group.create_task(self.device_session(device, self.client))
+        self._device_sessions[device.identifier] = task
+
+    async def device_session(self, device: Device, client: aiomqtt.Client):
+        device.connected = True
+        try:
+            await device.session(client)
+        finally:
+            device.connected = False
+
+    async def route_messages(self, client: aiomqtt.Client):
+        # The one consumer of the connection's messages, for every device
+        async for message in client.messages:
+            topic = message.topic.value
+            targets = [
+                device for device in self.devices.values() if device.routes(topic)
+            ]
+            if self.routes(topic) or not targets:
+                await self.on_message(message)
+            for device in targets:
+                await device.on_message(message)
+
+    async def session(self, client: aiomqtt.Client):
+        try:
+            async with asyncio.TaskGroup() as tg:
+                self._devices_group = tg
+                tg.create_task(super().session(client))
+                for device in self.devices.values():
+                    self.start_device_session(device)
+        finally:
+            self._devices_group = None
+            self._device_sessions.clear()
+
+    def collect_metrics(self, metrics: Metrics):
+        super().collect_metrics(metrics)
+        metrics.set("mqttdevice_gateway_devices", len(self.devices))
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import typing
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOSE = IN_CLOSE_WRITE | IN_CLOSE_NOWRITE
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_EVENT = struct.Struct("iIII")
+
+
+class Event(typing.NamedTuple):
+    path: str
+    mask: int
+    name: str
+
+    @property
+    def full_path(self) -> str:
+        return os.path.join(self.path, self.name) if self.name else self.path
+
+
+class Inotify:
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches: dict[int, str] = dict()
+
+    def __enter__(self) -> typing.Self:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_watch(self, path: str, mask: int):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+
+    def remove_watch(self, path: str):
+        for wd, watched in list(self.watches.items()):
+            if watched == path:
+                del self.watches[wd]
+                self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> list[Event]:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_IGNORED:
+                path = self.watches.pop(wd, "")
+            else:
+                path = self.watches.get(wd, "")
+            events.append(Event(path, mask, os.fsdecode(name)))
+        return events
+
+    async def events(self) -> typing.AsyncIterator[Event]:
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        fd = self.fd
+        loop.add_reader(fd, readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                for event in self.read():
+                    yield event
+        finally:
+            loop.remove_reader(fd)
+
+
+class FakeInotify:
+    """In-memory stand-in for Inotify, events are injected with emit()."""
+
+    def __init__(self):
+        self.watches: dict[str, int] = dict()
+        self._queue: asyncio.Queue[Event] = asyncio.Queue()
+
+    def __enter__(self) -> typing.Self:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.watches.clear()
+
+    def add_watch(self, path: str, mask: int):
+        self.watches[path] = mask
+
+    def remove_watch(self, path: str):
+        self.watches.pop(path, None)
+
+    def emit(self, path: str, mask: int, name: str = ""):
+        # Overflows aren't for a watch, they're always delivered
+        if mask & IN_Q_OVERFLOW or self.watches.get(path, 0) & mask:
+            self._queue.put_nowait(Event(path, mask, name))
+
+    async def events(self) -> typing.AsyncIterator[Event]:
+        while True:
+            yield await self._queue.get()
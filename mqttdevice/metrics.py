@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import logging
+import time
+import typing
+
+logger = logging.getLogger("mqttdevice.metrics")
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class HTTPConfig(typing.TypedDict):
+    host: str | None
+    port: int | None
+
+
+class MetricsConfig(typing.TypedDict):
+    http: HTTPConfig | None
+    topic: bool | None
+    interval: float | None
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(DEFAULT_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(DEFAULT_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    enabled = True
+
+    def __init__(self, config: MetricsConfig):
+        self.config = config
+        self._types: dict[str, str] = dict()
+        self._help: dict[str, str] = dict()
+        self._values: dict[str, dict[Labels, float]] = dict()
+        self._histograms: dict[str, dict[Labels, _Histogram]] = dict()
+        # Called before rendering, to update gauges that are cheaper to read
+        # than to keep up to date
+        self.collectors: list[typing.Callable[[Metrics], None]] = list()
+
+    @property
+    def interval(self) -> float:
+        return float(self.config.get("interval", 60))
+
+    def describe(self, name: str, kind: str, help: str) -> typing.Self:
+        self._types[name] = kind
+        self._help[name] = help
+        return self
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        values = self._values.setdefault(name, dict())
+        key = tuple(labels.items())
+        values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str):
+        self._values.setdefault(name, dict())[tuple(labels.items())] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        histograms = self._histograms.setdefault(name, dict())
+        key = tuple(labels.items())
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram()
+        histogram.observe(value)
+
+    def collect(self):
+        for collector in self.collectors:
+            collector(self)
+
+    @staticmethod
+    def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+        labels = labels + extra
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        self.collect()
+        lines = []
+        for name in sorted(self._values.keys() | self._histograms.keys()):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            if name in self._histograms:
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in self._histograms[name].items():
+                    cumulative = 0
+                    for bound, count in zip(
+                        DEFAULT_BUCKETS + ("+Inf",), histogram.counts
+                    ):
+                        cumulative += count
+                        le = self._format_labels(labels, (("le", str(bound)),))
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                    lines.append(
+                        f"{name}_sum{self._format_labels(labels)} {histogram.sum}"
+                    )
+                    lines.append(
+                        f"{name}_count{self._format_labels(labels)} {histogram.count}"
+                    )
+            else:
+                lines.append(f"# TYPE {name} {self._types.get(name, 'untyped')}")
+                for labels, value in self._values[name].items():
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        self.collect()
+        snapshot: dict[str, typing.Any] = dict()
+        for name, values in self._values.items():
+            snapshot[name] = [
+                dict(labels, value=value) for labels, value in values.items()
+            ]
+        for name, histograms in self._histograms.items():
+            snapshot[name] = [
+                dict(labels, count=histogram.count, sum=histogram.sum)
+                for labels, histogram in histograms.items()
+            ]
+        return snapshot
+
+    async def _handle_http(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            # Every request gets the metrics, whatever the path
+            while (await reader.readline()).strip():
+                pass
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve_http(self):
+        http = self.config.get("http")
+        if not http:
+            return
+        host = http.get("host", "127.0.0.1")
+        port = int(http.get("port", 9101))
+        server = await asyncio.start_server(self._handle_http, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+    async def monitor_loop_lag(self, interval: float = 1):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = time.monotonic() - start - interval
+            self.set("mqttdevice_event_loop_lag_seconds", lag)
+            self.observe("mqttdevice_event_loop_lag", lag)
+
+
+class NullMetrics(Metrics):
+    """Used when metrics aren't configured, everything is a no-op."""
+
+    enabled = False
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        pass
+
+    def set(self, name: str, value: float, **labels: str):
+        pass
+
+    def observe(self, name: str, value: float, **labels: str):
+        pass
+
+
+def get_metrics(config: MetricsConfig | None) -> Metrics:
+    if config is None:
+        return NullMetrics(MetricsConfig())
+    metrics = Metrics(config)
+    for name, kind, help in (
+        (
+            "mqttdevice_probe_seconds",
+            "histogram",
+            "Time taken to read an entity's state",
+        ),
+        ("mqttdevice_publishes_total", "counter", "States published"),
+        ("mqttdevice_publish_bytes_total", "counter", "Bytes of state published"),
+        (
+            "mqttdevice_publishes_suppressed_total",
+            "counter",
+            "Unchanged states not published",
+        ),
+        ("mqttdevice_reconnects_total", "counter", "Reconnections to the broker"),
+        ("mqttdevice_event_loop_lag_seconds", "gauge", "Last measured event loop lag"),
+        ("mqttdevice_event_loop_lag", "histogram", "Event loop lag in seconds"),
+        (
+            "mqttdevice_scheduler_lateness_seconds",
+            "histogram",
+            "How late polls started",
+        ),
+        (
+            "mqttdevice_outbox_size",
+            "gauge",
+            "States queued while the broker is unreachable",
+        ),
+        (
+            "mqttdevice_outbox_dropped_total",
+            "counter",
+            "States dropped from a full outbox",
+        ),
+        ("mqttdevice_command_seconds", "histogram", "Time taken by button commands"),
+        (
+            "mqttdevice_command_latency_seconds",
+            "histogram",
+            "Time from receiving a command to starting its handler",
+        ),
+        ("mqttdevice_commands_dropped_total", "counter", "Retained commands dropped"),
+        ("mqttdevice_gateway_devices", "gauge", "Devices hosted by the gateway"),
+    ):
+        metrics.describe(name, kind, help)
+    return metrics
@@ -1,14 +1,19 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 from abc import ABC, abstractmethod
-from typing import TypedDict
+from typing import TYPE_CHECKING, Awaitable, Callable, TypedDict
 
 import aiomqtt
 from aiomqtt.client import PayloadType, Properties
 
+from mqttdevice.backoff import Backoff, BackoffConfig
 from mqttdevice.exceptions import WillAlreadySetError
 
+if TYPE_CHECKING:
+    from mqttdevice.metrics import Metrics
+
 logger = logging.getLogger("mqttdevice")
 
 
@@ -17,24 +22,37 @@ class MQTTConfig(TypedDict):
     port: int | None
     username: str
     password: str
+    shared_connection: bool | None
+    reconnect: BackoffConfig | None
+    pending_calls_threshold: int | None
 
 
 class MQTTObject(ABC):
-    def __init__(self, config: MQTTConfig):
+    __slots__ = ("_mqtt_config", "logger", "connected", "owns_client", "client")
+
+    metrics: Metrics
+
+    def __init__(self, config: MQTTConfig, client: aiomqtt.Client | None = None):
         self._mqtt_config = config
 
-        self.logger = logging.getLogger(f"{logger.name}.{self.identifier}")
+        self.logger = self._get_logger()
         self.logger.info("Starting MQTT Device")
 
         self.connected = False
-        self.client: aiomqtt.Client = self._get_client()
+        # When a client is passed in, the connection is owned (and connected)
+        # by someone else and this object only publishes through it.
+        self.owns_client = client is None
+        self.client: aiomqtt.Client = client or self._get_client()
 
     @property
     def last_will(self) -> bool:
         return self.client._client._will
 
+    def _get_logger(self) -> logging.Logger | logging.LoggerAdapter:
+        return logging.getLogger(f"{logger.name}.{self.identifier}")
+
     def _get_client(self) -> aiomqtt.Client:
-        return aiomqtt.Client(
+        client = aiomqtt.Client(
             hostname=self._mqtt_config["host"],
             port=self._mqtt_config.get("port", 1883),
             username=self._mqtt_config["username"],
@@ -42,6 +60,12 @@ class MQTTObject(ABC):
             logger=self.logger,
             identifier=self.identifier,
         )
+        # One client carries every entity's publishes, so a poll has far more
+        # in flight than aiomqtt's default of 10 before it warns
+        client.pending_calls_threshold = int(
+            self._mqtt_config.get("pending_calls_threshold", 1000)
+        )
+        return client
 
     @property
     @abstractmethod
@@ -55,10 +79,44 @@ class MQTTObject(ABC):
         retain: bool = False,
         properties: Properties | None = None,
     ):
+        if not self.owns_client:
+            self.logger.debug(f"Using a shared connection, not setting will on {topic}")
+            return
         if self.last_will:
             raise WillAlreadySetError
         self.client._client.will_set(topic, payload, qos, retain, properties)
 
+    async def supervise(self, session: Callable[[aiomqtt.Client], Awaitable]):
+        # Runs session for as long as the connection lasts and reconnects with
+        # an exponential backoff when it's lost.
+        backoff = Backoff(self._mqtt_config.get("reconnect", BackoffConfig()))
+        connections = 0
+        while True:
+            # aiomqtt doesn't reset this after an unexpected disconnect, so
+            # reconnecting would return before the broker accepted us
+            if self.client._connected.done():
+                self.client._connected = asyncio.Future()
+            try:
+                async with self.client as client:
+                    backoff.reset()
+                    if connections:
+                        self.metrics.inc(
+                            "mqttdevice_reconnects_total", client=self.identifier
+                        )
+                    connections += 1
+                    self.connected = True
+                    try:
+                        await session(client)
+                    finally:
+                        self.connected = False
+            except* aiomqtt.MqttError as group:
+                self.logger.warning(
+                    f"Lost connection to the broker: {group.exceptions[0]}"
+                )
+            delay = backoff.next_delay()
+            self.logger.info(f"Reconnecting in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+
     @abstractmethod
     async def on_connect(self): ...
 
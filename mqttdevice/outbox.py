@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import typing
+from collections import OrderedDict
+
+if typing.TYPE_CHECKING:
+    import aiomqtt
+
+logger = logging.getLogger("mqttdevice.outbox")
+
+
+class OutboxConfig(typing.TypedDict):
+    max_size: int | None
+    drain_rate: float | None
+    spool: str | None
+    spool_interval: float | None
+
+
+class Outbox:
+    """Holds publishes made while the broker is unreachable.
+
+    Only the latest payload per topic is kept, so memory stays flat however
+    long the outage and the broker isn't flooded with stale states when the
+    connection comes back.
+    """
+
+    def __init__(self, config: OutboxConfig):
+        self.config = config
+        self._messages: OrderedDict[str, tuple[bytes, int, bool]] = OrderedDict()
+        self.dropped = 0
+        self._spool_write: asyncio.Task | None = None
+        self._dirty = False
+        self._load()
+
+    @property
+    def max_size(self) -> int:
+        return int(self.config.get("max_size", 1000))
+
+    @property
+    def drain_rate(self) -> float:
+        # Messages per second
+        return float(self.config.get("drain_rate", 50))
+
+    @property
+    def spool(self) -> str | None:
+        return self.config.get("spool")
+
+    @property
+    def spool_interval(self) -> float:
+        # Seconds changes are collected for before the spool is rewritten
+        return float(self.config.get("spool_interval", 1))
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def put(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        self._messages.pop(topic, None)
+        self._messages[topic] = (payload, qos, retain)
+        if len(self._messages) > self.max_size:
+            topic, _ = self._messages.popitem(last=False)
+            self.dropped += 1
+            logger.warning(f"Outbox full, dropped queued message for {topic}")
+        self._save()
+
+    def discard(self, topic: str):
+        # A newer value was published directly, so the queued one is stale
+        if self._messages.pop(topic, None) is not None:
+            self._save()
+
+    async def drain(self, client: aiomqtt.Client):
+        if self._messages:
+            logger.info(f"Publishing {len(self._messages)} queued messages")
+        while self._messages:
+            topic, message = next(iter(self._messages.items()))
+            payload, qos, retain = message
+            await client.publish(topic, payload, qos=qos, retain=retain)
+            # Only remove it if it wasn't replaced while publishing
+            if self._messages.get(topic) is message:
+                del self._messages[topic]
+            await asyncio.sleep(1 / self.drain_rate)
+        self._save()
+
+    def _load(self):
+        if not self.spool:
+            return
+        try:
+            with open(self.spool) as f:
+                spooled = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unable to read outbox spool {self.spool}: {e}")
+            return
+        for topic, (payload, qos, retain) in spooled.items():
+            self._messages[topic] = (base64.b64decode(payload), qos, retain)
+
+    def _save(self):
+        # Rewriting the whole spool per change would block the event loop, so
+        # changes are written out together, by one write at a time in a thread
+        if not self.spool:
+            return
+        self._dirty = True
+        if self._spool_write is None:
+            try:
+                self._spool_write = asyncio.get_running_loop().create_task(
+                    self._write_spool()
+                )
+            except RuntimeError:
+                # No event loop, e.g. at shutdown
+                self.flush()
+
+    async def _write_spool(self):
+        try:
+            while self._dirty:
+                await asyncio.sleep(self.spool_interval)
+                self._dirty = False
+                await asyncio.to_thread(self._write, self._spooled())
+        finally:
+            self._spool_write = None
+
+    def flush(self):
+        # Writes pending changes straight away
+        if self.spool and self._dirty:
+            self._dirty = False
+            self._write(self._spooled())
+
+    def _spooled(self) -> dict[str, list]:
+        return {
+            topic: [base64.b64encode(payload).decode(), qos, retain]
+            for topic, (payload, qos, retain) in self._messages.items()
+        }
+
+    def _write(self, spooled: dict[str, list]):
+        try:
+            with open(f"{self.spool}.tmp", "w") as f:
+                json.dump(spooled, f)
+            os.replace(f"{self.spool}.tmp", self.spool)
+        except OSError as e:
+            logger.warning(f"Unable to write outbox spool {self.spool}: {e}")
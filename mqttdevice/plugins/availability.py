@@ -1,10 +1,11 @@
-from homeassistant.components.binary_sensor import BinarySensorDeviceClass
-
+from mqttdevice.const import BinarySensorDeviceClass
 from mqttdevice.device import Device
 from mqttdevice.entities import BinarySensor, PluginConfig
 
 
 class Plugin(BinarySensor):
+    __slots__ = ()
+
     device_class = BinarySensorDeviceClass.CONNECTIVITY
 
     def get_state(self) -> bool:
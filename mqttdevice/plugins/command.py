@@ -1,5 +1,10 @@
-import subprocess
+import asyncio
+import os
+import signal
+import time
+from typing import Coroutine, Literal, Self
 
+import aiomqtt
 from aiomqtt.client import Message
 
 from mqttdevice.device import Device
@@ -8,15 +13,157 @@ from mqttdevice.entities import Button, PluginConfig
 
 class Config(PluginConfig):
     command: str
+    concurrency: int | None
+    policy: Literal["drop", "queue", "replace"] | None
+    queue_size: int | None
+    timeout: float | None
 
 
 class Plugin(Button):
+    __slots__ = (
+        "command",
+        "semaphore",
+        "tasks",
+        "processes",
+        "queued",
+        "presses",
+        "result_topic",
+    )
+
+    # Seconds between asking a command to stop and killing it
+    kill_grace = 5
+
     def __init__(self, device: Device, config: Config):
         self.command = config["command"]
+        self.semaphore = asyncio.Semaphore(int(config.get("concurrency", 1)))
+        self.tasks: set[asyncio.Task] = set()
+        self.processes: set[asyncio.subprocess.Process] = set()
+        self.queued = 0
+        self.presses = 0
         super().__init__(device, config)
 
+    def freeze(self) -> Self:
+        self.result_topic = f"mqttdevice/{self.identifier}/result"
+        return super().freeze()
+
+    def reconfigure(self, config: Config) -> bool:
+        if self.processes and config.get("concurrency") != self.config.get(
+            "concurrency"
+        ):
+            # Can't resize the semaphore under running commands
+            return False
+        if not super().reconfigure(config):
+            return False
+        self.command = config["command"]
+        self.semaphore = asyncio.Semaphore(int(config.get("concurrency", 1)))
+        return True
+
+    @property
+    def policy(self) -> str:
+        # What to do with a press while concurrency commands are running
+        return self.config.get("policy", "drop")
+
+    @property
+    def queue_size(self) -> int:
+        return int(self.config.get("queue_size", 1))
+
+    @property
+    def timeout(self) -> float | None:
+        return self.config.get("timeout")
+
+    def get_discovery_payload(self):
+        payload = super().get_discovery_payload()
+        payload["json_attributes_topic"] = self.result_topic
+        return payload
+
     async def on_message(self, message: Message):
-        subprocess.Popen(self.command, shell=True)
+        # The command runs in a task, so that the handler returns straight
+        # away and the policy sees presses made while it runs.
+        if self.semaphore.locked():
+            if self.policy == "drop":
+                self.logger.info("Command already running, dropping press")
+                return
+            if self.policy == "replace":
+                for process in list(self.processes):
+                    self.spawn(self.stop(process))
+            elif self.queued >= self.queue_size:
+                self.logger.info("Command queue full, dropping press")
+                return
+        self.presses += 1
+        self.queued += 1
+        self.spawn(self.execute(self.presses))
+
+    def spawn(self, coroutine: Coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def execute(self, press: int):
+        async with self.semaphore:
+            self.queued -= 1
+            if self.policy == "replace" and press != self.presses:
+                # Superseded by a later press while waiting
+                return
+            start = time.monotonic()
+            # In its own session, so that the shell and anything it started
+            # can be killed as a group
+            process = await asyncio.create_subprocess_shell(
+                self.command, start_new_session=True
+            )
+            self.processes.add(process)
+            timed_out = False
+            try:
+                await asyncio.wait_for(process.wait(), self.timeout)
+            except TimeoutError:
+                timed_out = True
+                self.logger.warning(f"Command timed out after {self.timeout} seconds")
+                await self.stop(process)
+            finally:
+                self.processes.discard(process)
+            duration = time.monotonic() - start
+        self.metrics.observe(
+            "mqttdevice_command_seconds", duration, entity=self.identifier
+        )
+        self.logger.info(
+            f"Command exited with {process.returncode} after {duration:.2f} seconds"
+        )
+        await self.publish_result(process.returncode, duration, timed_out)
+
+    async def stop(self, process: asyncio.subprocess.Process):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            try:
+                await asyncio.wait_for(process.wait(), self.kill_grace)
+            except TimeoutError:
+                os.killpg(process.pid, signal.SIGKILL)
+                await process.wait()
+        except ProcessLookupError:
+            pass
+
+    async def publish_result(self, exit_code: int, duration: float, timed_out: bool):
+        payload = {
+            "exit_code": exit_code,
+            "duration": round(duration, 3),
+            "timed_out": timed_out,
+        }
+        await self.device.publish(
+            self.result_topic,
+            self.device.serializer.dumps(payload),
+            self.client,
+            retain=True,
+            queue=True,
+        )
+
+    async def publish_removal(self, client: aiomqtt.Client | None = None):
+        # Stopped first, otherwise a command finishing afterwards would
+        # publish its result again
+        processes = list(self.processes)
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*(self.stop(process) for process in processes))
+        client = client or self.client
+        await super().publish_removal(client)
+        await client.publish(self.result_topic, b"", retain=True)
 
 
 def setup(device: Device, config: Config):
@@ -1,78 +1,195 @@
 from enum import StrEnum
+import asyncio
 import glob
-import json
+import logging
+import re
 
 import aiomqtt
+
+from mqttdevice.cache import SnapshotCache
+from mqttdevice.debounce import Debouncer
+from mqttdevice.const import BinarySensorDeviceClass
 from mqttdevice.device import Device
 from mqttdevice.entities import BinarySensor, PluginConfig
-
-from homeassistant.components.binary_sensor import BinarySensorDeviceClass
+from mqttdevice.serializer import get_serializer
 
 import subprocess
 
+logger = logging.getLogger("mqttdevice.plugins.pactl")
+
+LIST_SOURCES = ("pactl", "-f", "json", "list", "sources")
+SUBSCRIBE = ("pactl", "subscribe")
+# e.g. "Event 'change' on source #53", but not "... on source-output #12"
+SOURCE_EVENT = re.compile(r"Event '(?P<event>\w+)' on source #(?P<index>\d+)")
+
+# Shared by every source entity, so one poll of N sources runs pactl once
+sources_cache: SnapshotCache[dict[int, dict]] = SnapshotCache(ttl=1)
+
+
 class Config(PluginConfig):
     index: int
     metadata: dict
+    cache_ttl: float | None
+    subscribe: bool | None
+    fallback_interval: float | None
 
 class Plugin(BinarySensor):
+    __slots__ = ("monitor",)
+
     device_class = BinarySensorDeviceClass.SOUND
 
+    def __init__(
+        self, device: Device, config: Config, monitor: "SourceMonitor | None" = None
+    ):
+        self.monitor = monitor
+        super().__init__(device, config)
+
+    @property
+    def polling_interval(self) -> float:
+        # While pactl subscribe reports changes, polling is only a fallback
+        # for missed events
+        if self.monitor is not None and self.monitor.subscribed:
+            return float(self.config.get("fallback_interval", 600))
+        return super().polling_interval
+
     def get_discovery_payload(self):
-        source = self.get_source(self.config["index"])
         payload = super().get_discovery_payload()
         # payload["json_attributes"] = list(source.keys())
         payload["json_attributes_topic"] = self.state_topic
-        payload["json_attributes_template"] = "{{ value_json.metadata }}"
+        payload["json_attributes_template"] = self.get_value_template("metadata")
         return payload
 
     @staticmethod    
-    def list_sources() -> list[dict]:
+    def list_sources(timeout: float | None = None) -> list[dict]:
         try:
             result = subprocess.run(
-                ["pactl", "-f", "json", "list", "sources"],
+                list(LIST_SOURCES),
                 stdout=subprocess.PIPE,
                 stderr=subprocess.DEVNULL,
-                text=True
+                text=True,
+                timeout=timeout,
             )
-            sources = json.loads(result.stdout)
+            sources = get_serializer().loads(result.stdout)
 
             return sources
         except Exception:
             pass
 
         return []
-    
-    @classmethod
-    def get_source(cls, index: int) -> dict | None:
-        sources = cls.list_sources()
-        if sources:
-            for source in sources:
-                if source["index"] == index:
-                    return source
-
-
-    def get_state(self) -> tuple[bool | None, str | None]:
-        source = self.get_source(self.config["index"])
+
+    async def get_sources(self) -> dict[int, dict]:
+        return await get_sources(self.device, self.probe_timeout)
+
+    async def get_state(self) -> tuple[bool | None, dict | None]:
+        source = (await self.get_sources()).get(self.config["index"])
         if source:
             return source["state"] == "RUNNING", source
         return None, None
-    
-    async def publish_state(self, client: aiomqtt.Client | None = None) -> None:
-        client = client or self.client
 
-        state, metadata = self.get_state()
-        device_class = (self.device_class.value if isinstance(self.device_class, StrEnum) else self.device_class) or "state"
-        payload = {device_class: self.format_state(state), "metadata": metadata}
-        await client.publish(self.state_topic, json.dumps(payload), retain=True)
-        self.logger.info(f"Published state: {json.dumps(payload)}")
+    def get_state_payload(self, state: tuple[bool | None, dict | None]) -> dict:
+        state, metadata = state
+        payload = super().get_state_payload(state)
+        payload["metadata"] = metadata
+        return payload
 
 
-def setup(device: Device, config: PluginConfig):
-    for source in Plugin.list_sources():
-        _config = Config(
-            index=source["index"],
-            metadata=source,
-            id=f"{config['id']}_{source['name']}",
-            name=source['description']
+async def get_sources(device: Device, timeout: float | None = None) -> dict[int, dict]:
+    async def load() -> dict[int, dict]:
+        sources = await device.probes.run(
+            Plugin.list_sources, timeout or device.probes.timeout, key=LIST_SOURCES
         )
-        Plugin(device, _config)
+        return {source["index"]: source for source in sources}
+
+    return await sources_cache.get(LIST_SOURCES, load)
+
+
+class SourceMonitor:
+    # Events arriving within this many seconds of each other are handled as one
+    debounce = 0.05
+
+    def __init__(self, device: Device, config: Config):
+        self.device = device
+        self.config = config
+        self.entities: dict[int, Plugin] = dict()
+        self.changes: Debouncer[int] = Debouncer(self.debounce, self.flush)
+        self.subscribed = False
+
+    def add_source(self, source: dict) -> Plugin:
+        # Inherits the plugin's settings, such as probe_timeout
+        _config: Config = {
+            **self.config,
+            "index": source["index"],
+            "metadata": source,
+            "id": f"{self.config['id']}_{source['name']}",
+            "name": source["description"],
+        }
+        entity = Plugin(self.device, _config, self)
+        self.entities[source["index"]] = entity
+        return entity
+
+    async def run(self):
+        while True:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *SUBSCRIBE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+            except OSError as e:
+                logger.warning(f"Unable to run pactl subscribe, only polling: {e}")
+                return
+            self.set_subscribed(True)
+            try:
+                async for line in process.stdout:
+                    match = SOURCE_EVENT.match(line.decode())
+                    if match:
+                        self.on_event(int(match["index"]))
+            finally:
+                self.set_subscribed(False)
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+            logger.warning(
+                "pactl subscribe exited, restarting in "
+                f"{self.device.polling_interval} seconds"
+            )
+            await asyncio.sleep(self.device.polling_interval)
+
+    def set_subscribed(self, subscribed: bool):
+        self.subscribed = subscribed
+        # Scheduled again at the interval that applies now
+        for entity in self.entities.values():
+            if entity in self.device.scheduler:
+                self.device.scheduler.remove(entity).add(entity)
+
+    def on_event(self, index: int):
+        self.changes.add(index)
+
+    async def flush(self, pending: set[int]):
+        # pactl can't list a single source, so re-read once for the whole
+        # batch and only touch the entities whose source changed.
+        sources_cache.invalidate(LIST_SOURCES)
+        sources = await get_sources(self.device)
+        for index in pending:
+            await self.update_source(index, sources.get(index))
+
+    async def update_source(self, index: int, source: dict | None):
+        entity = self.entities.get(index)
+        try:
+            if entity is None and source is not None:
+                self.device.start_entity(self.add_source(source))
+            elif entity is not None and source is None:
+                del self.entities[index]
+                await self.device.retire_entity(entity)
+            elif entity is not None:
+                await entity.publish_state()
+        except aiomqtt.MqttError as e:
+            logger.warning(f"Unable to publish change to source {index}: {e}")
+
+def setup(device: Device, config: Config):
+    sources_cache.ttl = float(config.get("cache_ttl", sources_cache.ttl))
+    monitor = SourceMonitor(device, config)
+    for source in Plugin.list_sources():
+        monitor.add_source(source)
+    if config.get("subscribe", True):
+        device.add_service(monitor.run)
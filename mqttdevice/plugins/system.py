@@ -0,0 +1,331 @@
+import asyncio
+import glob
+import logging
+import os
+import time
+
+from mqttdevice.cache import SnapshotCache
+from mqttdevice.const import (
+    PERCENTAGE,
+    SensorDeviceClass,
+    UnitOfDataRate,
+    UnitOfInformation,
+    UnitOfTemperature,
+)
+from mqttdevice.device import Device
+from mqttdevice.entities import PluginConfig
+from mqttdevice.entities.sensor import Sensor, StreamingSensor
+
+logger = logging.getLogger("mqttdevice.plugins.system")
+
+PROC = "/proc"
+SYS = "/sys"
+
+# Key -> name, device class and unit of every sensor the plugin can expose
+SENSORS: dict[str, tuple[str, SensorDeviceClass | None, str | None]] = {
+    "cpu": ("CPU", None, PERCENTAGE),
+    "load_1": ("Load (1m)", None, None),
+    "load_5": ("Load (5m)", None, None),
+    "load_15": ("Load (15m)", None, None),
+    "memory_used": (
+        "Memory used",
+        SensorDeviceClass.DATA_SIZE,
+        UnitOfInformation.MEBIBYTES,
+    ),
+    "memory_available": (
+        "Memory available",
+        SensorDeviceClass.DATA_SIZE,
+        UnitOfInformation.MEBIBYTES,
+    ),
+    "swap_used": (
+        "Swap used",
+        SensorDeviceClass.DATA_SIZE,
+        UnitOfInformation.MEBIBYTES,
+    ),
+    "disk_read": (
+        "Disk read",
+        SensorDeviceClass.DATA_RATE,
+        UnitOfDataRate.KIBIBYTES_PER_SECOND,
+    ),
+    "disk_write": (
+        "Disk write",
+        SensorDeviceClass.DATA_RATE,
+        UnitOfDataRate.KIBIBYTES_PER_SECOND,
+    ),
+    "network_receive": (
+        "Network receive",
+        SensorDeviceClass.DATA_RATE,
+        UnitOfDataRate.KIBIBYTES_PER_SECOND,
+    ),
+    "network_transmit": (
+        "Network transmit",
+        SensorDeviceClass.DATA_RATE,
+        UnitOfDataRate.KIBIBYTES_PER_SECOND,
+    ),
+    "temperature": (
+        "Temperature",
+        SensorDeviceClass.TEMPERATURE,
+        UnitOfTemperature.CELSIUS,
+    ),
+}
+
+SECTOR_SIZE = 512
+
+
+class Config(PluginConfig):
+    sensors: list[str] | None
+    disks: list[str] | None
+    interfaces: list[str] | None
+    tick: float | None
+
+
+class SourceFile:
+    # Kept open and re-read from the start with pread, procfs and sysfs
+    # regenerate the contents on every read from offset 0.
+    __slots__ = ("path", "fd", "size")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = 4096
+
+    def read(self) -> bytes:
+        while True:
+            data = os.pread(self.fd, self.size, 0)
+            if len(data) < self.size:
+                return data
+            self.size *= 2
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Sampler:
+    """Reads every source once per tick and shares the values between sensors.
+
+    Counters such as bytes read are turned into rates against the previous
+    sample, so the first sample is taken straight away as a baseline.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        # Streaming sensors sample faster than once a second
+        sample_rate = config.get("sample_rate")
+        self.tick = float(
+            config.get("tick", 1 / float(sample_rate) if sample_rate else 1)
+        )
+        self.cache: SnapshotCache[dict[str, float | None]] = SnapshotCache(
+            ttl=self.tick
+        )
+        self.disks = set(config.get("disks") or self.find_disks())
+        self.interfaces = config.get("interfaces")
+        self.files: dict[str, SourceFile] = dict()
+        for name in ("stat", "loadavg", "meminfo", "diskstats", "net/dev"):
+            try:
+                self.files[name] = SourceFile(f"{PROC}/{name}")
+            except OSError as e:
+                logger.warning(f"Not reading {PROC}/{name}: {e}")
+        self.thermal_zones: list[SourceFile] = list()
+        for path in sorted(glob.glob(f"{SYS}/class/thermal/thermal_zone*/temp")):
+            try:
+                self.thermal_zones.append(SourceFile(path))
+            except OSError as e:
+                logger.warning(f"Not reading {path}: {e}")
+        self._counters: dict[str, int] = dict()
+        self._sampled_at = 0.0
+        self.values: dict[str, float | None] = dict()
+        self.sample()
+
+    @staticmethod
+    def find_disks() -> list[str]:
+        # Physical disks only: dm-* and md* are stacked on disks that are
+        # already counted, and loop, ram and zram have no device either.
+        # Partitions are counted in their disk's stats.
+        return [
+            name
+            for name in os.listdir(f"{SYS}/block")
+            if os.path.exists(f"{SYS}/block/{name}/device")
+        ]
+
+    @property
+    def available(self) -> set[str]:
+        # Sensors that can be read on this machine
+        available = set(SENSORS)
+        for name, keys in (
+            ("stat", ["cpu"]),
+            ("loadavg", ["load_1", "load_5", "load_15"]),
+            ("meminfo", ["memory_used", "memory_available", "swap_used"]),
+            ("diskstats", ["disk_read", "disk_write"]),
+            ("net/dev", ["network_receive", "network_transmit"]),
+        ):
+            if name not in self.files:
+                available.difference_update(keys)
+        if not self.thermal_zones:
+            available.discard("temperature")
+        return available
+
+    async def read(self) -> dict[str, float | None]:
+        async def load() -> dict[str, float | None]:
+            return self.sample()
+
+        return await self.cache.get(SYS, load)
+
+    def read_now(self) -> dict[str, float | None]:
+        # For streaming sensors, which sample on the event loop
+        if time.monotonic() - self._sampled_at >= self.tick:
+            return self.sample()
+        return self.values
+
+    def rate(
+        self, key: str, counter: int, elapsed: float, scale: float = 1
+    ) -> float | None:
+        previous = self._counters.get(key)
+        self._counters[key] = counter
+        if previous is None or elapsed <= 0:
+            return None
+        return round((counter - previous) * scale / elapsed, 2)
+
+    def sample(self) -> dict[str, float | None]:
+        now = time.monotonic()
+        elapsed = now - self._sampled_at
+        self._sampled_at = now
+        values: dict[str, float | None] = dict()
+        if "stat" in self.files:
+            values.update(self.sample_cpu(self.files["stat"].read()))
+        if "loadavg" in self.files:
+            load = self.files["loadavg"].read().split()
+            values["load_1"], values["load_5"], values["load_15"] = map(float, load[:3])
+        if "meminfo" in self.files:
+            values.update(self.sample_memory(self.files["meminfo"].read()))
+        if "diskstats" in self.files:
+            values.update(self.sample_disks(self.files["diskstats"].read(), elapsed))
+        if "net/dev" in self.files:
+            values.update(self.sample_network(self.files["net/dev"].read(), elapsed))
+        if self.thermal_zones:
+            values["temperature"] = self.sample_temperature()
+        self.values = values
+        return values
+
+    def sample_cpu(self, stat: bytes) -> dict[str, float | None]:
+        # user nice system idle iowait irq softirq steal, in ticks
+        times = [int(value) for value in stat.split(b"\n", 1)[0].split()[1:9]]
+        total = sum(times)
+        busy = total - times[3] - times[4]
+        total_delta = total - self._counters.get("cpu_total", total)
+        busy_delta = busy - self._counters.get("cpu_busy", busy)
+        self._counters["cpu_total"], self._counters["cpu_busy"] = total, busy
+        if not total_delta:
+            return {"cpu": self.values.get("cpu")}
+        return {"cpu": round(busy_delta * 100 / total_delta, 1)}
+
+    def sample_memory(self, meminfo: bytes) -> dict[str, float | None]:
+        fields = dict()
+        for line in meminfo.splitlines():
+            name, value = line.split(b":", 1)
+            fields[name] = int(value.split()[0])  # kB
+        available = fields.get(b"MemAvailable", fields[b"MemFree"])
+        return {
+            "memory_used": round((fields[b"MemTotal"] - available) / 1024, 1),
+            "memory_available": round(available / 1024, 1),
+            "swap_used": round((fields[b"SwapTotal"] - fields[b"SwapFree"]) / 1024, 1),
+        }
+
+    def sample_disks(self, diskstats: bytes, elapsed: float) -> dict[str, float | None]:
+        read = written = 0
+        for line in diskstats.splitlines():
+            fields = line.split()
+            if fields[2].decode() in self.disks:
+                read += int(fields[5])
+                written += int(fields[9])
+        return {
+            "disk_read": self.rate("disk_read", read, elapsed, SECTOR_SIZE / 1024),
+            "disk_write": self.rate("disk_write", written, elapsed, SECTOR_SIZE / 1024),
+        }
+
+    def sample_network(self, net_dev: bytes, elapsed: float) -> dict[str, float | None]:
+        received = transmitted = 0
+        for line in net_dev.splitlines()[2:]:
+            interface, counters = line.split(b":", 1)
+            interface = interface.strip().decode()
+            if self.interfaces is None and interface == "lo":
+                continue
+            if self.interfaces is not None and interface not in self.interfaces:
+                continue
+            fields = counters.split()
+            received += int(fields[0])
+            transmitted += int(fields[8])
+        return {
+            "network_receive": self.rate(
+                "network_receive", received, elapsed, 1 / 1024
+            ),
+            "network_transmit": self.rate(
+                "network_transmit", transmitted, elapsed, 1 / 1024
+            ),
+        }
+
+    def sample_temperature(self) -> float | None:
+        # The hottest zone, some zones fail to read while their sensor is off
+        temperatures = []
+        for zone in self.thermal_zones:
+            try:
+                temperatures.append(int(zone.read()))
+            except (OSError, ValueError):
+                pass
+        return max(temperatures) / 1000 if temperatures else None
+
+    async def run(self):
+        # Keeps the sources open for as long as the plugin is loaded
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.close()
+
+    def close(self):
+        for source in [*self.files.values(), *self.thermal_zones]:
+            source.close()
+
+
+class Plugin(Sensor):
+    __slots__ = ("key", "sampler", "device_class", "unit_of_measurement")
+
+    def __init__(self, device: Device, config: Config, key: str, sampler: Sampler):
+        self.key = key
+        self.sampler = sampler
+        name, self.device_class, self.unit_of_measurement = SENSORS[key]
+        super().__init__(
+            device, {**config, "id": f"{config['id']}_{key}", "name": name}
+        )
+
+    async def get_state(self) -> float | None:
+        return (await self.sampler.read()).get(self.key)
+
+
+class StreamingPlugin(StreamingSensor):
+    __slots__ = ("key", "sampler", "device_class", "unit_of_measurement")
+
+    def __init__(self, device: Device, config: Config, key: str, sampler: Sampler):
+        self.key = key
+        self.sampler = sampler
+        name, self.device_class, self.unit_of_measurement = SENSORS[key]
+        super().__init__(
+            device, {**config, "id": f"{config['id']}_{key}", "name": name}
+        )
+
+    def get_sample(self) -> float | None:
+        return self.sampler.read_now().get(self.key)
+
+
+def setup(device: Device, config: Config):
+    sampler = Sampler(config)
+    available = sampler.available
+    # With a sample rate the sensors report min, max, mean and last per poll
+    plugin = StreamingPlugin if config.get("sample_rate") else Plugin
+    for key in config.get("sensors") or SENSORS:
+        if key not in SENSORS:
+            logger.error(f"Unknown system sensor {key}")
+            continue
+        if key not in available:
+            logger.warning(f"System sensor {key} isn't available on this machine")
+            continue
+        plugin(device, config, key, sampler)
+    device.add_service(sampler.run)
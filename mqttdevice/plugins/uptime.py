@@ -1,14 +1,12 @@
-import json
-import aiomqtt
-from homeassistant.components.sensor import SensorDeviceClass
-from homeassistant.const import UnitOfTime
-
+from mqttdevice.const import SensorDeviceClass, UnitOfTime
 from mqttdevice.device import Device
 from mqttdevice.entities import PluginConfig
 from mqttdevice.entities.sensor import Sensor
 
 
 class Plugin(Sensor):
+    __slots__ = ()
+
     default_name = "Uptime"
     device_class = SensorDeviceClass.DURATION
     unit_of_measurement = UnitOfTime.SECONDS
@@ -17,12 +15,15 @@ class Plugin(Sensor):
         with open("/proc/uptime") as f:
             return float(f.read().split()[0])
 
-    async def on_connect(self, client: aiomqtt.Client):
-        await super().on_connect(client)
-        device_class = (self.device_class.value if isinstance(self.device_class, SensorDeviceClass) else self.device_class) or "state"
+    def __init__(self, device: Device, config: PluginConfig):
+        super().__init__(device, config)
+        if self.device.aggregate_state:
+            # The state topic is shared with the other entities
+            return
+        # Set before connecting, the broker only takes the will at connect
         self.will_set(
             self.state_topic,
-            json.dumps({device_class: 0}),
+            self.device.serializer.dumps({self.state_key: 0}),
             retain=True,
         )
 
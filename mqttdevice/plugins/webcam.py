@@ -1,38 +1,105 @@
-from enum import StrEnum
 import glob
-import json
+import logging
+import os
+import re
+import typing
 
 import aiomqtt
+
+from mqttdevice import inotify
+from mqttdevice.cache import SnapshotCache
+from mqttdevice.const import BinarySensorDeviceClass
+from mqttdevice.debounce import Debouncer
 from mqttdevice.device import Device
 from mqttdevice.entities import BinarySensor, PluginConfig
 
-from homeassistant.components.binary_sensor import BinarySensorDeviceClass
-
 import subprocess
 
+logger = logging.getLogger("mqttdevice.plugins.webcam")
+
+PROC = "/proc"
+DEV = "/dev"
+VIDEO_NODE = re.compile(r"video\d+$")
+
+# (st_dev, st_ino) of every open device node -> name of a process holding it,
+# shared by every webcam so one poll scans /proc once.
+openers_cache: SnapshotCache[dict[tuple[int, int], str]] = SnapshotCache(ttl=1)
+
+
 class Config(PluginConfig):
     device_path: str
+    backend: str | None
+    cache_ttl: float | None
+    hotplug: bool | None
+
+
+def scan_proc(proc: str = PROC) -> dict[tuple[int, int], str]:
+    openers: dict[tuple[int, int], str] = dict()
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        fd_dir = f"{proc}/{pid}/fd"
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # Exited, or owned by another user
+            continue
+        name = None
+        for fd in fds:
+            path = f"{fd_dir}/{fd}"
+            try:
+                if not os.readlink(path).startswith("/dev/"):
+                    continue
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name is None:
+                try:
+                    with open(f"{proc}/{pid}/comm") as f:
+                        name = f.read().strip()
+                except OSError:
+                    name = pid
+            openers.setdefault((stat.st_dev, stat.st_ino), name)
+    return openers
+
+
+async def get_openers(
+    device: Device, timeout: float | None = None
+) -> dict[tuple[int, int], str]:
+    async def load() -> dict[tuple[int, int], str]:
+        return await device.probes.run(scan_proc, PROC, timeout=timeout, key=PROC)
+
+    return await openers_cache.get(PROC, load)
 
 
 class Plugin(BinarySensor):
+    __slots__ = ()
+
     device_class = BinarySensorDeviceClass.RUNNING
 
     def get_discovery_payload(self):
         payload = super().get_discovery_payload()
         payload["json_attributes"] = ["process"]
         payload["json_attributes_topic"] = self.state_topic
-        payload["json_attributes_template"] = "{{ value_json.metadata }}"
+        payload["json_attributes_template"] = self.get_value_template("metadata")
         return payload
 
+    @property
+    def backend(self) -> str:
+        backend = self.config.get("backend", "proc")
+        if backend == "proc" and not os.path.isdir(f"{PROC}/self/fd"):
+            return "lsof"
+        return backend
 
-    def get_state(self) -> tuple[bool | None, str | None]:
-        path = self.config["device_path"]
+    @staticmethod
+    def lsof(path: str, timeout: float | None = None) -> tuple[bool | None, str | None]:
         try:
             result = subprocess.run(
                 ["lsof", "-w", path],  # -w suppresses warnings
                 stdout=subprocess.PIPE,
                 stderr=subprocess.DEVNULL,  # Suppress unwanted errors
-                text=True
+                text=True,
+                timeout=timeout,
             )
             lines = result.stdout.strip().split("\n")
             if len(lines) > 1:  # First line is headers, subsequent lines are processes
@@ -42,19 +109,135 @@ class Plugin(BinarySensor):
             return None, None
 
         return False, None
-    
-    async def publish_state(self, client: aiomqtt.Client | None = None) -> None:
-        client = client or self.client
 
-        state, process = self.get_state()
-        device_class = (self.device_class.value if isinstance(self.device_class, StrEnum) else self.device_class) or "state"
-        payload = {device_class: self.format_state(state), "metadata": {"process":process}}
-        await client.publish(self.state_topic, json.dumps(payload), retain=True)
-        self.logger.info(f"Published state: {json.dumps(payload)}")
+    async def get_state(self) -> tuple[bool | None, str | None]:
+        path = self.config["device_path"]
+        if self.backend == "lsof":
+            return await self.device.probes.run(
+                self.lsof,
+                path,
+                self.probe_timeout or self.device.probes.timeout,
+                key=self.identifier,
+            )
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None, None
+        openers = await get_openers(self.device, self.probe_timeout)
+        process = openers.get((stat.st_dev, stat.st_ino))
+        return process is not None, process
+
+    def get_state_payload(self, state: tuple[bool | None, str | None]) -> dict:
+        state, process = state
+        payload = super().get_state_payload(state)
+        payload["metadata"] = {"process": process}
+        return payload
+
+
+class CameraMonitor:
+    # Apps tend to open and close every camera when probing, and the fd only
+    # shows up in /proc after IN_OPEN fires, so wait a little before scanning.
+    debounce = 0.1
 
+    def __init__(
+        self,
+        device: Device,
+        config: Config,
+        watcher_factory: typing.Callable[[], inotify.Inotify] = inotify.Inotify,
+    ):
+        self.device = device
+        self.config = config
+        self.watcher_factory = watcher_factory
+        self.entities: dict[str, Plugin] = dict()
+        self._watcher: inotify.Inotify | None = None
+        self.changes: Debouncer[str] = Debouncer(self.debounce, self.flush)
 
-def setup(device: Device, config: PluginConfig):
-    for path in glob.glob("/dev/video*"):
+    def add_camera(self, path: str) -> Plugin:
         suffix = path.lstrip("/dev/video")
-        _config = Config(device_path=path, id=f"{config['id']}_{suffix}", name=f"Webcam {path}")
-        Plugin(device, _config)
+        # Inherits the plugin's settings, such as probe_timeout
+        _config: Config = {
+            **self.config,
+            "device_path": path,
+            "id": f"{self.config['id']}_{suffix}",
+            "name": f"Webcam {path}",
+        }
+        entity = Plugin(self.device, _config)
+        self.entities[path] = entity
+        return entity
+
+    def watch_camera(self, path: str):
+        try:
+            self._watcher.add_watch(path, inotify.IN_OPEN | inotify.IN_CLOSE)
+        except OSError as e:
+            logger.warning(f"Unable to watch {path}, it will only be polled: {e}")
+
+    async def run(self):
+        try:
+            watcher = self.watcher_factory()
+        except OSError as e:
+            logger.warning(f"inotify is unavailable, only polling webcams: {e}")
+            return
+        with watcher:
+            self._watcher = watcher
+            watcher.add_watch(DEV, inotify.IN_CREATE | inotify.IN_DELETE)
+            for path in self.entities:
+                self.watch_camera(path)
+            async for event in watcher.events():
+                await self.on_event(event)
+
+    async def on_event(self, event: inotify.Event):
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            await self.rescan()
+        elif event.path == DEV:
+            if VIDEO_NODE.match(event.name):
+                await self.on_hotplug(event)
+        elif event.path in self.entities and event.mask & (
+            inotify.IN_OPEN | inotify.IN_CLOSE
+        ):
+            self.on_change(event.path)
+
+    async def on_hotplug(self, event: inotify.Event):
+        path = event.full_path
+        try:
+            if event.mask & inotify.IN_CREATE and path not in self.entities:
+                self.device.start_entity(self.add_camera(path))
+                self.watch_camera(path)
+            elif event.mask & inotify.IN_DELETE and path in self.entities:
+                await self.device.retire_entity(self.entities.pop(path))
+        except aiomqtt.MqttError as e:
+            logger.warning(f"Unable to publish hotplug of {path}: {e}")
+
+    async def rescan(self):
+        # Events were dropped, so work out what changed from scratch
+        paths = set(glob.glob(f"{DEV}/video*"))
+        for path in paths - set(self.entities):
+            name = os.path.basename(path)
+            await self.on_hotplug(inotify.Event(DEV, inotify.IN_CREATE, name))
+        for path in set(self.entities) - paths:
+            name = os.path.basename(path)
+            await self.on_hotplug(inotify.Event(DEV, inotify.IN_DELETE, name))
+        for path in self.entities:
+            self.on_change(path)
+
+    def on_change(self, path: str):
+        self.changes.add(path)
+
+    async def flush(self, pending: set[str]):
+        openers_cache.invalidate(PROC)
+        for path in pending:
+            entity = self.entities.get(path)
+            if entity is None:
+                continue
+            try:
+                await entity.publish_state()
+            except aiomqtt.MqttError as e:
+                logger.warning(f"Unable to publish change to {path}: {e}")
+
+
+def setup(device: Device, config: Config):
+    openers_cache.ttl = float(config.get("cache_ttl", openers_cache.ttl))
+    monitor = CameraMonitor(device, config)
+    for path in glob.glob(f"{DEV}/video*"):
+        monitor.add_camera(path)
+    if config.get("hotplug", True):
+        device.add_service(monitor.run)
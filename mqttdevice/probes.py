@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import typing
+
+if typing.TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+    from mqttdevice.shards import ShardPool
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+from mqttdevice.exceptions import ProbeTimeoutError
+
+logger = logging.getLogger("mqttdevice.probes")
+
+T = typing.TypeVar("T")
+
+
+class ProbeConfig(typing.TypedDict):
+    executor: typing.Literal["thread", "process", "sharded"] | None
+    max_workers: int | None
+    shards: int | None
+    timeout: float | None
+
+
+class ProbeExecutor:
+    """Runs blocking probes off the event loop in a bounded pool.
+
+    Bound methods (e.g. a synchronous ``get_state``) always run in the thread
+    pool. ``run`` uses the process pool or shards when configured, so anything
+    passed to it must be picklable, such as a module level function. With
+    shards, probes passed the same key always run in the same process.
+    """
+
+    def __init__(self, config: ProbeConfig):
+        self.config = config
+        self._threads = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="mqttdevice-probe"
+        )
+        self._processes: ProcessPoolExecutor | None = None
+        if self.executor == "process":
+            # Imported here as it pulls in multiprocessing, which most configs don't use
+            from concurrent.futures import ProcessPoolExecutor
+
+            self._processes = ProcessPoolExecutor(max_workers=self.max_workers)
+        self._shards: ShardPool | None = None
+        if self.executor == "sharded":
+            from mqttdevice.shards import ShardPool
+
+            self._shards = ShardPool(self.shards)
+
+    @property
+    def executor(self) -> str:
+        return self.config.get("executor", "thread")
+
+    @property
+    def max_workers(self) -> int:
+        return int(self.config.get("max_workers", 4))
+
+    @property
+    def shards(self) -> int:
+        # Worker processes, one per core by default
+        return int(self.config.get("shards", os.cpu_count() or 1))
+
+    @property
+    def timeout(self) -> float:
+        return float(self.config.get("timeout", 10))
+
+    async def wait_for(
+        self, awaitable: typing.Awaitable[T], timeout: float | None = None
+    ) -> T:
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except TimeoutError:
+            raise ProbeTimeoutError(f"Probe timed out after {timeout} seconds")
+
+    async def _run_in(
+        self,
+        executor: Executor,
+        func: typing.Callable[..., T],
+        *args,
+        timeout: float | None = None,
+    ) -> T:
+        loop = asyncio.get_running_loop()
+        return await self.wait_for(loop.run_in_executor(executor, func, *args), timeout)
+
+    async def run(
+        self,
+        func: typing.Callable[..., T],
+        *args,
+        timeout: float | None = None,
+        key: typing.Hashable | None = None,
+    ) -> T:
+        if self._shards is not None:
+            # Timed by the shard, from when the worker starts the probe
+            timeout = self.timeout if timeout is None else timeout
+            return await self._shards.get_shard(key).call(func, *args, timeout=timeout)
+        return await self._run_in(
+            self._processes or self._threads, func, *args, timeout=timeout
+        )
+
+    async def run_in_thread(
+        self, func: typing.Callable[..., T], *args, timeout: float | None = None
+    ) -> T:
+        return await self._run_in(self._threads, func, *args, timeout=timeout)
+
+    def shutdown(self):
+        self._threads.shutdown(wait=False, cancel_futures=True)
+        if self._processes:
+            self._processes.shutdown(wait=False, cancel_futures=True)
+        if self._shards:
+            self._shards.shutdown()
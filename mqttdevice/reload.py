@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import signal
+
+import yaml
+
+from mqttdevice import inotify
+from mqttdevice.debounce import Debouncer
+from mqttdevice.device import Device
+
+logger = logging.getLogger("mqttdevice.reload")
+
+
+class ConfigReloader:
+    """Reloads the plugins from the config file on SIGHUP or when it changes."""
+
+    # Editors write a file in several steps, changes within this many seconds
+    # of each other are one reload
+    debounce = 0.5
+
+    def __init__(self, device: Device, path: str):
+        self.device = device
+        self.path = os.path.abspath(path)
+        self.changes: Debouncer[str] = Debouncer(self.debounce, self.reload)
+
+    def install(self) -> ConfigReloader:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.schedule)
+        return self
+
+    def schedule(self):
+        self.changes.add(self.path)
+
+    async def reload(self, _paths: set[str]):
+        try:
+            with open(self.path) as f:
+                config = yaml.safe_load(f)
+        except (OSError, yaml.YAMLError) as e:
+            logger.error(f"Not reloading, unable to read {self.path}: {e}")
+            return
+        logger.info(f"Reloading {self.path}")
+        try:
+            await self.device.reload(config)
+        except Exception:
+            logger.exception("Reload failed")
+
+    async def watch(self):
+        # Watches the directory, as editors often replace the file
+        directory, name = os.path.split(self.path)
+        try:
+            watcher = inotify.Inotify()
+        except OSError as e:
+            logger.warning(f"inotify is unavailable, only reloading on SIGHUP: {e}")
+            return
+        with watcher:
+            watcher.add_watch(directory, inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO)
+            async for event in watcher.events():
+                if event.name == name:
+                    self.schedule()
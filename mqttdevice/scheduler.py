@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+    import aiomqtt
+
+    from mqttdevice.metrics import Metrics
+
+logger = logging.getLogger("mqttdevice.scheduler")
+
+
+class Pollable(typing.Protocol):
+    client: aiomqtt.Client
+
+    @property
+    def identifier(self) -> str: ...
+
+    @property
+    def polling_interval(self) -> float: ...
+
+    async def on_loop(self, client: aiomqtt.Client): ...
+
+
+class SchedulerConfig(typing.TypedDict):
+    jitter: float | None
+    tick: float | None
+
+
+class _Entry:
+    __slots__ = ("item", "removed", "running")
+
+    def __init__(self, item: Pollable):
+        self.item = item
+        self.removed = False
+        self.running = False
+
+
+class _Group:
+    # Everything polled at one interval, kept in phase so it's polled as one
+    # batch, and so probes that share a snapshot read it once per poll
+    __slots__ = ("interval", "base", "entries")
+
+    def __init__(self, interval: float, base: float):
+        self.interval = interval
+        # Ideal time of the next poll, always advanced by exactly one interval
+        # so that the time spent polling doesn't stretch the period.
+        self.base = base
+        self.entries: dict[int, _Entry] = dict()
+
+
+class Scheduler:
+    """Polls everything added to it from a single heap of due times.
+
+    Items with the same polling interval are polled together as one batch.
+    Each interval's first poll lands at a random phase within it and every
+    batch is jittered around its ideal time, so hosts started together don't
+    all hit the broker in the same second. Batches due within one tick of
+    each other are polled together too.
+    """
+
+    def __init__(self, config: SchedulerConfig, metrics: Metrics):
+        self.config = config
+        self.metrics = metrics
+        self._heap: list[tuple[float, int, _Group]] = list()
+        self._groups: dict[float, _Group] = dict()
+        self._entries: dict[int, tuple[_Group, _Entry]] = dict()
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self.lateness = 0.0
+
+    @property
+    def jitter(self) -> float:
+        # Fraction of the polling interval
+        return float(self.config.get("jitter", 0.1))
+
+    @property
+    def tick(self) -> float:
+        return float(self.config.get("tick", 0.1))
+
+    def add(self, item: Pollable) -> typing.Self:
+        if id(item) in self._entries:
+            # Already scheduled, keep its phase
+            return self
+        interval = item.polling_interval
+        if interval <= 0:
+            # Event driven only
+            return self
+        group = self._groups.get(interval)
+        if group is None:
+            group = _Group(interval, time.monotonic() + random.uniform(0, interval))
+            self._groups[interval] = group
+            self._push(group)
+        entry = _Entry(item)
+        group.entries[id(item)] = entry
+        self._entries[id(item)] = (group, entry)
+        return self
+
+    def __contains__(self, item: Pollable) -> bool:
+        return id(item) in self._entries
+
+    def remove(self, item: Pollable) -> typing.Self:
+        group, entry = self._entries.pop(id(item), (None, None))
+        if entry is not None:
+            entry.removed = True
+            del group.entries[id(item)]
+            if not group.entries:
+                # Dropped from the heap when it's next due
+                del self._groups[group.interval]
+        return self
+
+    def clear(self) -> typing.Self:
+        for _, entry in self._entries.values():
+            entry.removed = True
+        self._entries.clear()
+        self._groups.clear()
+        self._heap.clear()
+        return self
+
+    def _push(self, group: _Group):
+        # Spread over a window jitter * interval wide, centred on the ideal time
+        offset = random.uniform(-self.jitter, self.jitter) * group.interval / 2
+        heapq.heappush(self._heap, (group.base + offset, next(self._counter), group))
+        self._wakeup.set()
+
+    def _reschedule(self, group: _Group, now: float):
+        group.base += group.interval
+        if group.base < now:
+            # Too far behind to catch up, skip the missed polls
+            group.base += group.interval * math.ceil(
+                (now - group.base) / group.interval
+            )
+        self._push(group)
+
+    def _pop_due(self, now: float) -> list[_Entry]:
+        batch = []
+        taken: set[int] = set()
+        while self._heap and self._heap[0][0] <= now + self.tick:
+            due, _, group = heapq.heappop(self._heap)
+            if self._groups.get(group.interval) is not group:
+                # Emptied, or emptied and replaced by a new group
+                continue
+            self.lateness = max(0.0, now - due)
+            self.metrics.observe("mqttdevice_scheduler_lateness_seconds", self.lateness)
+            self._reschedule(group, now)
+            for key, entry in group.entries.items():
+                if key in taken:
+                    # Its interval is shorter than a tick, so the group came
+                    # round again in this pass
+                    continue
+                if entry.running:
+                    logger.warning(
+                        f"Still polling {entry.item.identifier}, skipping a poll"
+                    )
+                    continue
+                # Running from now, not from when its task starts
+                entry.running = True
+                taken.add(key)
+                batch.append(entry)
+        return batch
+
+    async def _poll(self, entry: _Entry):
+        try:
+            await entry.item.on_loop(entry.item.client)
+        except Exception:
+            # One broken entity shouldn't stop everything else being polled
+            logger.exception(f"Error polling {entry.item.identifier}")
+        finally:
+            entry.running = False
+
+    async def _poll_batch(self, batch: list[_Entry]):
+        await asyncio.gather(*(self._poll(entry) for entry in batch))
+
+    async def run(self):
+        async with asyncio.TaskGroup() as tg:
+            while True:
+                self._wakeup.clear()
+                now = time.monotonic()
+                batch = self._pop_due(now)
+                if batch:
+                    logger.debug(f"Polling {len(batch)} entities")
+                    tg.create_task(self._poll_batch(batch))
+                    continue
+                timeout = self._heap[0][0] - now if self._heap else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except TimeoutError:
+                    pass
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import json
+import logging
+import typing
+
+logger = logging.getLogger("mqttdevice.serializer")
+
+
+class Serializer:
+    """Serializes payloads straight to the bytes that are published.
+
+    Output is compact and UTF-8, the same as orjson's, so payloads (and the
+    hashes and change detection based on them) don't depend on which
+    serializer is used.
+    """
+
+    name = "json"
+
+    # Built once, json.dumps builds an encoder per call when given options
+    _encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+    def dumps(self, value: typing.Any) -> bytes:
+        return self._encoder.encode(value).encode()
+
+    def loads(self, data: bytes | str) -> typing.Any:
+        return json.loads(data)
+
+
+class ORJSONSerializer(Serializer):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self._orjson = orjson
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, value: typing.Any) -> bytes:
+        # orjson returns bytes with at least 1 KiB allocated whatever their
+        # length, which adds up for payloads kept per entity. A copy is
+        # exactly sized and still much faster than json.
+        return bytes(memoryview(self._orjson.dumps(value, option=self._options)))
+
+    def loads(self, data: bytes | str) -> typing.Any:
+        return self._orjson.loads(data)
+
+
+SERIALIZERS: dict[str, type[Serializer]] = {
+    "json": Serializer,
+    "orjson": ORJSONSerializer,
+}
+
+
+def get_serializer(name: str | None = None) -> Serializer:
+    # orjson when it's installed, unless a serializer is configured
+    if name is not None:
+        return SERIALIZERS[name]()
+    try:
+        return ORJSONSerializer()
+    except ImportError:
+        logger.debug("orjson isn't installed, using json")
+        return Serializer()
@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import signal
+import typing
+from collections import OrderedDict
+
+from mqttdevice.exceptions import ProbeTimeoutError, ShardError
+
+if typing.TYPE_CHECKING:
+    from multiprocessing.connection import Connection
+    from multiprocessing.process import BaseProcess
+
+logger = logging.getLogger("mqttdevice.shards")
+
+T = typing.TypeVar("T")
+
+
+def serve(connection: Connection):
+    # Runs in the worker: calls functions as they arrive on the pipe and sends
+    # back (call id, whether it succeeded, result or exception)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            call_id, func, args = connection.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            response = (call_id, True, func(*args))
+        except Exception as e:
+            response = (call_id, False, e)
+        try:
+            connection.send(response)
+        except (EOFError, OSError):
+            return
+        except Exception as e:
+            # The result or exception didn't pickle
+            connection.send((call_id, False, RuntimeError(repr(e))))
+
+
+class _Call:
+    __slots__ = ("func", "args", "timeout", "future")
+
+    def __init__(
+        self, func: typing.Callable, args: tuple, timeout: float, future: asyncio.Future
+    ):
+        self.func = func
+        self.args = args
+        self.timeout = timeout
+        self.future = future
+
+
+class Shard:
+    """One worker process, called over a pipe.
+
+    The parent doesn't need a thread per worker, responses are read from the
+    pipe when the event loop sees it's readable. Calls run one at a time in
+    the order they were sent, so a call's timeout starts when the call before
+    it finishes rather than while it's queued. A call that times out or
+    kills the worker fails on its own, the calls queued behind it are sent
+    again to a new worker.
+    """
+
+    def __init__(self, index: int, context: multiprocessing.context.BaseContext):
+        self.index = index
+        self.context = context
+        # In the order they were sent, the first one is running
+        self.pending: OrderedDict[int, _Call] = OrderedDict()
+        self._call_ids = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+        self.connection: Connection | None = None
+        self.process: BaseProcess | None = None
+
+    def start(self):
+        connection, child = self.context.Pipe()
+        self.process = self.context.Process(
+            target=serve,
+            args=(child,),
+            name=f"mqttdevice-shard-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self.connection = connection
+        asyncio.get_running_loop().add_reader(connection.fileno(), self.on_readable)
+
+    def call(
+        self, func: typing.Callable[..., T], *args, timeout: float
+    ) -> asyncio.Future[T]:
+        if self.connection is None:
+            self.start()
+        call_id = next(self._call_ids)
+        call = _Call(func, args, timeout, asyncio.get_running_loop().create_future())
+        self.connection.send((call_id, func, args))
+        self.pending[call_id] = call
+        if len(self.pending) == 1:
+            self._start_timer()
+        return call.future
+
+    def _start_timer(self):
+        # Times the call that is running now
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.pending:
+            call_id, call = next(iter(self.pending.items()))
+            self._timer = asyncio.get_running_loop().call_later(
+                call.timeout, self.on_timeout, call_id
+            )
+
+    def on_timeout(self, call_id: int):
+        self._timer = None
+        call = self.pending.pop(call_id)
+        # The worker is stuck in it, so it's replaced
+        logger.warning(f"Restarting shard {self.index} after a probe timed out")
+        self.fail(
+            call, ProbeTimeoutError(f"Probe timed out after {call.timeout} seconds")
+        )
+        self.restart()
+
+    def on_readable(self):
+        try:
+            call_id, ok, result = self.connection.recv()
+        except (EOFError, OSError):
+            logger.warning(f"Shard {self.index} exited, restarting it")
+            if self.pending:
+                _, call = self.pending.popitem(last=False)
+                self.fail(call, ShardError(f"Shard {self.index} exited"))
+            self.restart()
+            return
+        call = self.pending.pop(call_id, None)
+        self._start_timer()
+        # Calls whose caller gave up are cancelled, their result is dropped
+        if call is None or call.future.done():
+            return
+        if ok:
+            call.future.set_result(result)
+        else:
+            call.future.set_exception(result)
+
+    @staticmethod
+    def fail(call: _Call, exception: Exception):
+        if not call.future.done():
+            call.future.set_exception(exception)
+
+    def restart(self):
+        queued = list(self.pending.values())
+        self.pending.clear()
+        self.close()
+        if not queued:
+            # Started again by the next call
+            return
+        self.start()
+        for call in queued:
+            if call.future.done():
+                # Its caller gave up
+                continue
+            call_id = next(self._call_ids)
+            try:
+                self.connection.send((call_id, call.func, call.args))
+            except Exception as e:
+                self.fail(call, ShardError(f"Unable to call shard {self.index}: {e}"))
+                continue
+            self.pending[call_id] = call
+        self._start_timer()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.connection is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.connection.fileno())
+            except RuntimeError:
+                # Closed after the event loop
+                pass
+            self.connection.close()
+            self.connection = None
+        if self.process is not None:
+            self.process.terminate()
+            self.process = None
+        for call in self.pending.values():
+            self.fail(call, ShardError(f"Shard {self.index} exited"))
+        self.pending.clear()
+
+
+class ShardPool:
+    """Spreads blocking probes over worker processes, one per core by default.
+
+    Probes for the same key always run in the same worker, so per-process
+    caches stay warm and one entity's probes never run concurrently. The
+    parent keeps the MQTT connection, workers only return values.
+    """
+
+    def __init__(self, shards: int):
+        # forkserver rather than fork, the parent has threads and an event loop
+        context = multiprocessing.get_context("forkserver")
+        self.shards = [Shard(index, context) for index in range(shards)]
+        self._next = itertools.cycle(self.shards)
+
+    def get_shard(self, key: typing.Hashable | None) -> Shard:
+        if key is None:
+            return next(self._next)
+        return self.shards[hash(key) % len(self.shards)]
+
+    def shutdown(self):
+        for shard in self.shards:
+            shard.close()
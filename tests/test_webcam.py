@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from mqttdevice import inotify
+from mqttdevice.device import Device
+from mqttdevice.plugins import webcam
+
+CONFIG = {
+    "mqtt": {"host": "127.0.0.1", "port": 1883, "username": None, "password": None},
+    "device_name": "test",
+    "polling_interval": 0,
+    "plugins": [],
+}
+
+
+class Harness:
+    """A CameraMonitor watched through FakeInotify, recording what it does."""
+
+    def __init__(self, monkeypatch: pytest.MonkeyPatch):
+        self.device = Device(dict(CONFIG))
+        self.started: list[str] = []
+        self.retired: list[str] = []
+        self.changed: list[set[str]] = []
+        monkeypatch.setattr(
+            self.device,
+            "start_entity",
+            lambda entity: self.started.append(entity.config["device_path"]),
+        )
+        monkeypatch.setattr(self.device, "retire_entity", self.retire_entity)
+        self.watcher = inotify.FakeInotify()
+        self.monitor = webcam.CameraMonitor(
+            self.device, {"id": "webcam"}, watcher_factory=lambda: self.watcher
+        )
+        self.monitor.changes.handler = self.on_changes
+
+    async def retire_entity(self, entity: webcam.Plugin):
+        self.retired.append(entity.config["device_path"])
+
+    async def on_changes(self, paths: set[str]):
+        self.changed.append(paths)
+
+    async def settle(self):
+        # Lets the monitor handle the events and the debounce run out
+        await asyncio.sleep(self.monitor.debounce * 2)
+
+
+def run(test):
+    return asyncio.run(test())
+
+
+def test_hotplug(monkeypatch):
+    async def test():
+        harness = Harness(monkeypatch)
+        task = asyncio.create_task(harness.monitor.run())
+        await asyncio.sleep(0)
+        harness.watcher.emit(webcam.DEV, inotify.IN_CREATE, "video7")
+        await harness.settle()
+        assert harness.started == ["/dev/video7"]
+        assert "/dev/video7" in harness.monitor.entities
+        assert "/dev/video7" in harness.watcher.watches
+
+        harness.watcher.emit(webcam.DEV, inotify.IN_DELETE, "video7")
+        await harness.settle()
+        assert harness.retired == ["/dev/video7"]
+        assert harness.monitor.entities == {}
+        task.cancel()
+
+    run(test)
+
+
+def test_open_and_close_are_debounced(monkeypatch):
+    async def test():
+        harness = Harness(monkeypatch)
+        harness.monitor.add_camera("/dev/video0")
+        task = asyncio.create_task(harness.monitor.run())
+        await asyncio.sleep(0)
+        harness.watcher.emit("/dev/video0", inotify.IN_OPEN)
+        harness.watcher.emit("/dev/video0", inotify.IN_CLOSE_NOWRITE)
+        harness.watcher.emit("/dev/video0", inotify.IN_OPEN)
+        await harness.settle()
+        assert harness.changed == [{"/dev/video0"}]
+        task.cancel()
+
+    run(test)
+
+
+def test_overflow_rescans(monkeypatch, tmp_path):
+    async def test():
+        monkeypatch.setattr(webcam, "DEV", str(tmp_path))
+        (tmp_path / "video0").touch()
+        (tmp_path / "video1").touch()
+        harness = Harness(monkeypatch)
+        harness.monitor.add_camera(str(tmp_path / "video0"))
+        harness.monitor.add_camera(str(tmp_path / "video2"))
+        task = asyncio.create_task(harness.monitor.run())
+        await asyncio.sleep(0)
+        harness.watcher.emit("", inotify.IN_Q_OVERFLOW)
+        await harness.settle()
+        assert harness.started == [str(tmp_path / "video1")]
+        assert harness.retired == [str(tmp_path / "video2")]
+        assert harness.changed == [{str(tmp_path / "video0"), str(tmp_path / "video1")}]
+        task.cancel()
+
+    run(test)